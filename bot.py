@@ -1,22 +1,54 @@
 import os
+import io
+import re
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import socket
+import sqlite3
+import hmac
+import html
+import time
+import heapq
+import bisect
+import itertools
+import statistics
+import uuid
+import signal
+import secrets
 import asyncio
+import threading
+import concurrent.futures
+import traceback
 import logging
+from logging.handlers import RotatingFileHandler
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import ExitStack, closing, contextmanager
+from functools import partial
 from typing import Dict, List, Set, Tuple, Optional
 from datetime import datetime
 import tempfile
 import shutil
 import psutil
+from pathlib import Path
 
 from telegram import (
+    Bot,
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
     InputFile,
+    InputMediaDocument,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove
 )
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    ExtBot,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -24,9 +56,10 @@ from telegram.ext import (
     filters
 )
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
+from aiohttp import web
 
 import subprocess
-import json
 
 # ===== CONFIGURATION =====
 API_ID = 22768311
@@ -36,11 +69,107 @@ BOT_TOKEN = ""
 OWNER_ID = 6040503076
 ADMIN_IDS = {OWNER_ID}  # Add more admin IDs as needed
 
+# ffmpeg resource isolation - keeps remuxes from starving the bot and downloads
+FFMPEG_NICE = 10  # Added niceness (0 = unchanged, 19 = lowest CPU priority)
+FFMPEG_IONICE_CLASS = "best-effort"  # "idle", "best-effort" or "" for unchanged
+FFMPEG_IONICE_LEVEL = 7  # Best-effort level (0 = highest, 7 = lowest)
+FFMPEG_CPU_AFFINITY: Optional[Set[int]] = None  # e.g. {1, 2, 3} to leave CPU 0 to the bot
+FFMPEG_CGROUP_ROOT = "/sys/fs/cgroup/trackkiller"  # cgroup v2, used if it exists and is writable
+FFMPEG_CGROUP_CPU_MAX = "max 100000"  # cpu.max per job, e.g. "200000 100000" = 2 CPUs
+FFMPEG_CGROUP_IO_WEIGHT = 50  # io.weight per job (1-10000, default 100)
+FFMPEG_CGROUP_MEMORY_MAX = "max"  # memory.max per job
+
+FFMPEG_CAPABILITIES_CACHE = "ffmpeg_capabilities.json"  # Detected once per ffmpeg build
+NATIVE_PROBE_ENABLED = True  # Read MKV/MP4 track tables in-process, ffprobe for the rest
+NATIVE_REMUX_ENABLED = True  # Strip tracks from Matroska in-process, ffmpeg for everything else
+NATIVE_REMUX_MAX_ELEMENT = 256 * 1024 * 1024  # Largest cluster/header held in memory
+
+# Local Bot API server (telegram-bot-api --local) on the same host
+LOCAL_BOT_API_URL = ""  # e.g. "http://127.0.0.1:8081/bot" - empty = hosted Bot API
+LOCAL_BOT_API_FILE_URL = LOCAL_BOT_API_URL.replace('/bot', '/file/bot')
+LOCAL_MODE = bool(LOCAL_BOT_API_URL)
+
+# Helper bots that share the job file transfers (hosted Bot API only). Every
+# helper and the main bot must be admins of the private transfer channel.
+HELPER_BOT_TOKENS: List[str] = []
+TRANSFER_CHANNEL_ID = 0  # e.g. -1001234567890
+HELPER_FAILURE_COOLDOWN = 30  # Seconds, doubled for each consecutive failure
+
 # Bot settings - OPTIMIZED FOR PRIVATE USE
 BOT_MODE = "private"  # Private mode only
-MAX_FILE_SIZE = 950 * 1024 * 1024  # 950MB limit
+MAX_FILE_SIZE = (2000 if LOCAL_MODE else 950) * 1024 * 1024  # Local server allows 2000MB uploads
 MAX_CONCURRENT_PROCESSES = 6  # Increased to 6 for private use
-PROCESS_TIMEOUT = 300  # 5 minutes timeout
+PROCESS_TIMEOUT = 300  # Fallback ffmpeg timeout, jobs get their own from the cost model
+
+# Scratch storage: small jobs on a RAM-backed tmpfs, the rest on disk. A job's
+# input and outputs always share one directory, so they share a filesystem.
+SCRATCH_RAM_DIR = "/dev/shm"  # "" = never use RAM
+SCRATCH_RAM_MAX_FILE = 200 * 1024 * 1024  # Videos up to this size go to RAM
+SCRATCH_RAM_BUDGET = 2 * 1024 * 1024 * 1024  # RAM scratch reserved by all jobs together
+SCRATCH_DISK_DIR = ""  # Fast disk for everything else, "" = system temp dir
+
+# Speculative prefetch: download and probe a video as soon as it arrives
+PREFETCH_ENABLED = True
+PREFETCH_MAX_FILE = 500 * 1024 * 1024  # Bigger videos wait until an option is picked
+PREFETCH_MAX_ACTIVE = 3  # Prefetches running at once
+PREFETCH_TTL = 15 * 60  # Delete an unused prefetched file after this many seconds
+
+# Per-user quotas, so one user cannot hold every slot or saturate ingest
+USER_MAX_CONCURRENT_JOBS = 2
+USER_MAX_QUEUED_JOBS = 5  # Jobs accepted but not running yet
+USER_BYTES_PER_HOUR = 10 * 1024 * 1024 * 1024  # Video bytes a user may submit per hour
+
+# Job queue: "local" runs jobs in this process, "sqlite"/"mongodb" hand them
+# to worker processes started with `python bot.py worker`
+JOB_QUEUE_BACKEND = "local"
+JOB_QUEUE_SQLITE_PATH = "jobs.sqlite3"  # Workers on the same host
+MONGO_URI = "mongodb://localhost:27017"  # Workers on any host
+MONGO_DATABASE = "trackkiller"
+WORKER_POLL_INTERVAL = 2  # Seconds between claim attempts on an empty queue
+WORKER_HEARTBEAT_INTERVAL = 15
+WORKER_STALE_AFTER = 60  # Re-queue running jobs without a heartbeat for this long
+MAX_JOB_ATTEMPTS = 3
+JOB_RETENTION = 7 * 24 * 3600  # Finished jobs are kept for /trace lookups
+
+# Update delivery
+DELIVERY_MODE = "polling"  # "polling" or "webhook"
+WEBHOOK_URL = ""  # Public HTTPS URL Telegram posts to, e.g. https://bot.example.com/telegram
+WEBHOOK_LISTEN = "127.0.0.1"  # Bind address, keep local behind a reverse proxy
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = ""  # Empty = random token generated on every start
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Outgoing Bot API calls, per bot
+API_GLOBAL_RATE = 25  # Calls per second to all chats
+API_CHAT_RATE = 1  # Calls per second to one private chat
+API_GROUP_RATE = 20 / 60  # Calls per second to one group or channel
+API_CHAT_BURST = 3
+API_MAX_RETRIES = 5  # Retries after RetryAfter (FloodWait) before a call fails
+
+# Event loop watchdog and profiler
+LOOP_WATCHDOG_INTERVAL = 0.1  # Heartbeat period in seconds
+LOOP_STALL_THRESHOLD = 0.5  # Log the blocking stack when the loop stalls this long
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005  # 200 samples per second
+
+# Job tracing
+TRACE_LOG_FILE = "traces.jsonl"  # One JSON line per finished job
+TRACE_LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate trace log at 10MB
+TRACE_LOG_BACKUPS = 5
+TRACE_RECENT_LIMIT = 200  # Finished traces kept in memory for /trace
+TRACE_WATERFALL_WIDTH = 24
+TELEGRAM_MESSAGE_LIMIT = 4096  # Characters per message
+
+# Job cost model and scheduling
+COST_MODEL_SAMPLES = 500  # Recent samples kept per stage and container
+COST_MODEL_MIN_SAMPLES = 8  # Fewer samples fall back to median throughput
+TIMEOUT_SAFETY_FACTOR = 4  # ffmpeg timeout = predicted duration x factor + slack
+TIMEOUT_SLACK = 60
+TIMEOUT_MIN = 60
+TIMEOUT_MAX = 3 * 3600
+SCHEDULER_AGING = 1.0  # Seconds of predicted work forgiven per second waited
+MAX_QUEUED_JOBS = 20  # Local jobs waiting for a slot before new ones are refused
 
 # ===== LOGGING SETUP =====
 logging.basicConfig(
@@ -51,10 +180,18 @@ logger = logging.getLogger(__name__)
 
 # ===== GLOBAL VARIABLES =====
 user_sessions = {}
+user_quotas = {}  # user_id -> UserQuota
 active_processes = {}
 admins = ADMIN_IDS.copy()
 current_processes = 0
+admitted_jobs = 0  # Local jobs accepted and not finished yet (waiting or running)
 process_lock = asyncio.Lock()
+shared_queue = None  # SQLiteJobQueue / MongoJobQueue when workers run the jobs
+transfer_pool = None  # TransferPool when helper bots are configured
+ffmpeg_capabilities: Dict = {}  # Empty = unknown, assume everything is supported
+scratch_dirs: Dict[str, int] = {}  # Job scratch directory -> RAM bytes reserved for it
+prefetch_tasks: Set[asyncio.Task] = set()
+background_tasks: Set[asyncio.Task] = set()
 
 # Emojis for better UI
 EMOJI_SELECTED = "✅ "
@@ -71,21 +208,32 @@ EMOJI_SUCCESS = "✅"
 EMOJI_ERROR = "❌"
 
 # ===== RESOURCE MANAGEMENT =====
-async def can_process_video() -> bool:
-    """Check if system can handle another video processing task"""
+async def reserve_job_slot() -> bool:
+    """Admit a video processing task if the system can take it.
+    
+    The check and the count happen under one lock, so concurrent updates
+    cannot both take the last place. Pair with release_job_slot().
+    """
+    global admitted_jobs
     async with process_lock:
-        if current_processes >= MAX_CONCURRENT_PROCESSES:
-            return False
-        
-        # Check system resources
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        
-        if cpu_percent > 85 or memory.percent > 85:
-            return False
+        if shared_queue is None:  # Workers claim shared queue jobs at their own pace
+            # Full slots are fine - the scheduler queues the job
+            if admitted_jobs >= MAX_CONCURRENT_PROCESSES + MAX_QUEUED_JOBS:
+                return False
             
+            # Check system resources
+            memory = psutil.virtual_memory()
+            if memory.percent > 85:
+                return False
+        
+        admitted_jobs += 1
         return True
 
+async def release_job_slot():
+    global admitted_jobs
+    async with process_lock:
+        admitted_jobs -= 1
+
 async def increment_process_count():
     """Increment active process count"""
     global current_processes
@@ -98,6 +246,240 @@ async def decrement_process_count():
     async with process_lock:
         current_processes -= 1
 
+class TokenBucket:
+    """Token bucket; with no refill rate it is a counter of tokens handed back on release"""
+
+    def __init__(self, capacity: float, refill_per_second: float = 0.0):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def try_take(self, amount: float = 1) -> bool:
+        self._refill()
+        if amount > self.tokens:
+            return False
+        self.tokens -= amount
+        return True
+
+    def take(self, amount: float = 1):
+        """Take tokens even if that overdraws the bucket"""
+        self._refill()
+        self.tokens -= amount
+
+    def give_back(self, amount: float = 1):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def seconds_until(self, amount: float) -> float:
+        """How long until `amount` tokens are available (inf if never)"""
+        missing = amount - self.available()
+        if missing <= 0:
+            return 0.0
+        return missing / self.refill_per_second if self.refill_per_second else float('inf')
+
+class UserQuota:
+    """A user's running jobs, queued jobs and hourly byte allowance"""
+
+    def __init__(self):
+        self.running = TokenBucket(USER_MAX_CONCURRENT_JOBS)
+        self.queued = TokenBucket(USER_MAX_QUEUED_JOBS)
+        # Never smaller than one maximum size file, or that file could never be sent
+        self.bytes = TokenBucket(max(USER_BYTES_PER_HOUR, MAX_FILE_SIZE), USER_BYTES_PER_HOUR / 3600)
+
+    def bytes_used(self) -> float:
+        return self.bytes.capacity - self.bytes.available()
+
+def get_user_quota(user_id: int) -> UserQuota:
+    if user_id not in user_quotas:
+        user_quotas[user_id] = UserQuota()
+    return user_quotas[user_id]
+
+async def check_user_quota(user_id: int, file_size: int) -> Optional[str]:
+    """Admit a job against the user's quotas; returns the refusal message, if any"""
+    quota = get_user_quota(user_id)
+    
+    if shared_queue is not None:
+        # Workers start jobs, so the queue knows how many are still waiting
+        usage = await asyncio.to_thread(shared_queue.user_stats)
+        queued = usage.get(user_id, {}).get('queued', 0)
+    else:
+        queued = USER_MAX_QUEUED_JOBS - quota.queued.available()
+    if queued >= USER_MAX_QUEUED_JOBS:
+        return f"❌ You already have {USER_MAX_QUEUED_JOBS} jobs waiting. Please wait for them to finish."
+    
+    if not quota.bytes.try_take(file_size):
+        wait = quota.bytes.seconds_until(file_size)
+        return (
+            f"❌ Hourly limit of {USER_BYTES_PER_HOUR / (1024 ** 3):.1f}GB reached. "
+            f"Try again in {format_eta(wait)}."
+        )
+    
+    return None
+
+def refund_user_bytes(user_id: int, file_size: int):
+    """Hand back a job's byte charge when it failed or was given up"""
+    get_user_quota(user_id).bytes.give_back(file_size)
+
+def get_quota_status(queue_usage: Optional[Dict] = None) -> str:
+    """Per-user quota usage lines for /status"""
+    user_ids = sorted(set(user_quotas) | set(queue_usage or {}))
+    lines = []
+    for user_id in user_ids:
+        quota = get_user_quota(user_id)
+        if queue_usage is not None:
+            usage = queue_usage.get(user_id, {})
+            running, queued = usage.get('running', 0), usage.get('queued', 0)
+        else:
+            running = USER_MAX_CONCURRENT_JOBS - quota.running.available()
+            queued = USER_MAX_QUEUED_JOBS - quota.queued.available()
+        lines.append(
+            f"`{user_id}`: {running:.0f}/{USER_MAX_CONCURRENT_JOBS} running | "
+            f"{queued:.0f}/{USER_MAX_QUEUED_JOBS} queued | "
+            f"{quota.bytes_used() / (1024 ** 3):.1f}/{USER_BYTES_PER_HOUR / (1024 ** 3):.1f}GB this hour"
+        )
+    return "\n".join(lines)
+
+# ===== TELEGRAM CALL SCHEDULER =====
+API_LANES = {'interactive': 0, 'progress': 1}
+PROGRESS_UPDATE = {'priority': 'progress'}  # rate_limit_args for job status edits
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after is an int or a timedelta depending on the library version"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+
+class TelegramCallScheduler(BaseRateLimiter):
+    """Schedules one bot's outgoing API calls.
+
+    Calls to a chat wait for the global and per-chat token buckets, user-facing
+    calls ahead of progress edits. A progress edit of a message that is still
+    waiting replaces the older one. Calls failing with RetryAfter are retried
+    once the chat (or the whole bot) is allowed to send again.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(API_GLOBAL_RATE, API_GLOBAL_RATE)
+        self.chat_buckets: Dict = {}
+        self.paused_until: Dict = {}  # chat_id (None = all calls) -> monotonic time
+        self.retries = 0
+        self.coalesced = 0
+        self._waiting: List[List] = []  # [lane, sequence, chat_id, coalesce_key, future]
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            private = isinstance(chat_id, int) and chat_id > 0
+            self.chat_buckets[chat_id] = TokenBucket(API_CHAT_BURST, API_CHAT_RATE if private else API_GROUP_RATE)
+        return self.chat_buckets[chat_id]
+
+    def _ready_in(self, chat_id) -> float:
+        """Seconds until a call to the chat may go out"""
+        paused = max(self.paused_until.get(None, 0), self.paused_until.get(chat_id, 0)) - time.monotonic()
+        return max(paused, self.global_bucket.seconds_until(1), self._chat_bucket(chat_id).seconds_until(1))
+
+    def _grant(self, chat_id):
+        self.global_bucket.take()
+        self._chat_bucket(chat_id).take()
+
+    async def _dispatch(self):
+        """Release waiting calls in lane order as the buckets allow"""
+        while True:
+            self._wakeup.clear()
+            delay = None
+            for entry in sorted(self._waiting):
+                chat_id, future = entry[2], entry[-1]
+                if future.done():
+                    continue
+                ready_in = self._ready_in(chat_id)
+                if ready_in <= 0:
+                    self._grant(chat_id)
+                    future.set_result(True)
+                elif delay is None or ready_in < delay:
+                    delay = ready_in
+            self._waiting = [entry for entry in self._waiting if not entry[-1].done()]
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _admit(self, chat_id, lane: int, coalesce_key) -> bool:
+        """Wait for the call's turn; False if a newer progress edit replaced it"""
+        if coalesce_key is not None:
+            for entry in self._waiting:
+                if entry[3] == coalesce_key and not entry[-1].done():
+                    entry[-1].set_result(False)
+                    self.coalesced += 1
+        
+        if not any(not entry[-1].done() for entry in self._waiting) and self._ready_in(chat_id) <= 0:
+            self._grant(chat_id)
+            return True
+        
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append([lane, next(self._sequence), chat_id, coalesce_key, future])
+        self._wakeup.set()
+        return await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = API_LANES[(rate_limit_args or {}).get('priority', 'interactive')]
+        chat_id = data.get('chat_id')
+        coalesce_key = None
+        if lane == API_LANES['progress'] and endpoint == 'editMessageText':
+            coalesce_key = (chat_id, data.get('message_id'))
+        
+        for attempt in range(API_MAX_RETRIES + 1):
+            if chat_id is not None:
+                if not await self._admit(chat_id, lane, coalesce_key):
+                    return True  # A newer status edit of the same message went out instead
+            else:
+                # Calls without a chat (getFile, ...) only honour a bot-wide FloodWait
+                paused = self.paused_until.get(None, 0) - time.monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+            
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == API_MAX_RETRIES:
+                    raise
+                wait = retry_after_seconds(e)
+                self.retries += 1
+                self.paused_until[chat_id] = time.monotonic() + wait
+                self._wakeup.set()
+                logger.warning(f"Flood limit on {endpoint} (chat {chat_id}), retrying in {wait}s")
+                if chat_id is None:
+                    await asyncio.sleep(wait)
+
+    def summary(self) -> str:
+        """One line for /status"""
+        return (
+            f"📮 API: {sum(1 for entry in self._waiting if not entry[-1].done())} waiting | "
+            f"{self.retries} flood retries | {self.coalesced} edits coalesced"
+        )
+
+api_scheduler = TelegramCallScheduler()
+
 def get_system_status() -> str:
     """Get current system status"""
     cpu_percent = psutil.cpu_percent()
@@ -111,6 +493,546 @@ def get_system_status() -> str:
         f"⚡ Processes: {current_processes}/{MAX_CONCURRENT_PROCESSES}"
     )
 
+# ===== JOB TRACING =====
+trace_logger = logging.getLogger("trackkiller.trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False  # Keep JSON lines out of the console log
+_trace_handler = RotatingFileHandler(
+    TRACE_LOG_FILE,
+    maxBytes=TRACE_LOG_MAX_BYTES,
+    backupCount=TRACE_LOG_BACKUPS,
+    encoding='utf-8',
+    delay=True
+)
+_trace_handler.setFormatter(logging.Formatter('%(message)s'))
+trace_logger.addHandler(_trace_handler)
+
+recent_traces: "OrderedDict[str, JobTrace]" = OrderedDict()
+
+FFMPEG_SPEED_RE = re.compile(r'speed=\s*([\d.]+)x')
+
+class JobTrace:
+    """Timed spans for one job, written to the trace log when finished"""
+
+    def __init__(self, kind: str, user_id: int, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:8]
+        self.kind = kind
+        self.user_id = user_id
+        self.started_at = datetime.now()
+        self.status = 'running'
+        self.duration: Optional[float] = None
+        self.spans: List[Dict] = []
+        self.meta: Dict = {}  # Job features for the cost model (size, container, tracks)
+        self._t0 = time.monotonic()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a pipeline stage. The yielded dict can be updated with extra attributes."""
+        span = {'name': name, 'start': time.monotonic() - self._t0, 'duration': None}
+        span.update(attrs)
+        self.spans.append(span)
+        try:
+            yield span
+        except BaseException:
+            span['error'] = True
+            raise
+        finally:
+            span['duration'] = time.monotonic() - self._t0 - span['start']
+            if span.get('bytes') and span['duration'] > 0:
+                span['mb_per_s'] = span['bytes'] / (1024 * 1024) / span['duration']
+
+    def finish(self, status: str):
+        """Close the trace and append it to the trace log (only once)"""
+        if self.duration is not None:
+            return
+        self.status = status
+        self.duration = time.monotonic() - self._t0
+        try:
+            trace_logger.info(json.dumps(self.to_dict()))
+        except Exception as e:
+            logger.error(f"Error writing trace {self.trace_id}: {e}")
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'user_id': self.user_id,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'status': self.status,
+            'duration': self.duration if self.duration is not None else time.monotonic() - self._t0,
+            'meta': self.meta,
+            'spans': self.spans
+        }
+
+def start_trace(kind: str, user_id: int, trace_id: Optional[str] = None) -> JobTrace:
+    """Create a trace and register it for /trace"""
+    trace = JobTrace(kind, user_id, trace_id)
+    recent_traces[trace.trace_id] = trace
+    while len(recent_traces) > TRACE_RECENT_LIMIT:
+        recent_traces.popitem(last=False)
+    return trace
+
+def load_trace_from_log(trace_id: str) -> Optional[Dict]:
+    """Look up a finished trace in the (rotated) trace log files"""
+    log_files = [TRACE_LOG_FILE] + [f"{TRACE_LOG_FILE}.{i}" for i in range(1, TRACE_LOG_BACKUPS + 1)]
+    for log_file in log_files:
+        if not os.path.exists(log_file):
+            continue
+        try:
+            with open(log_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if trace_id not in line:
+                        continue
+                    record = json.loads(line)
+                    if record.get('trace_id') == trace_id:
+                        return record
+        except Exception as e:
+            logger.error(f"Error reading trace log {log_file}: {e}")
+    return None
+
+def format_span_details(span: Dict) -> str:
+    """Short human readable extras for a span (size, throughput, ffmpeg speed)"""
+    details = []
+    if span.get('bytes'):
+        details.append(f"{span['bytes'] / (1024 * 1024):.1f}MB")
+    elif span.get('size'):
+        details.append(f"{span['size'] / (1024 * 1024):.1f}MB in place")
+    if span.get('mb_per_s'):
+        details.append(f"{span['mb_per_s']:.1f}MB/s")
+    if span.get('tier'):
+        details.append(span['tier'])
+    if span.get('speed'):
+        details.append(f"{span['speed']:.1f}x")
+    if span.get('error'):
+        details.append("ERR")
+    return " ".join(details)
+
+def format_trace_waterfall(trace: Dict) -> str:
+    """Render a trace as a monospace waterfall chart"""
+    total = max(trace.get('duration') or 0, 0.001)
+    width = TRACE_WATERFALL_WIDTH
+    spans = trace.get('spans', [])
+    name_width = max([len(span['name']) for span in spans] + [4])
+
+    lines = [
+        f"Job {trace['trace_id']} • {trace['kind']} • {total:.1f}s • {trace['status']}",
+        f"User {trace['user_id']} • {trace['started_at']}"
+    ]
+    for span in spans:
+        duration = span.get('duration') or 0
+        offset = min(int(span['start'] / total * width), width - 1)
+        length = max(1, min(round(duration / total * width), width - offset))
+        bar = " " * offset + "█" * length + " " * (width - offset - length)
+        lines.append(
+            f"{span['name']:<{name_width}} |{bar}| {duration:6.1f}s {format_span_details(span)}".rstrip()
+        )
+    return "\n".join(lines)
+
+def pack_pre_messages(header: str, blocks: List[str]) -> List[str]:
+    """Fit text blocks into <pre> messages under Telegram's length limit.
+    
+    Blocks are kept whole where possible; a block too long for one message
+    is cut at a line boundary and marked as truncated.
+    """
+    header = html.escape(header)
+    limit = TELEGRAM_MESSAGE_LIMIT - len("<pre></pre>") - len(header) - 2
+    messages, current = [], []
+    for block in blocks:
+        escaped = html.escape(block)
+        if len(escaped) > limit:
+            kept = []
+            for line in escaped.split("\n"):
+                if len("\n".join(kept + [line, "…"])) > limit:
+                    break
+                kept.append(line)
+            escaped = "\n".join(kept + ["…"])
+        if current and len("\n\n".join(current + [escaped])) > limit:
+            messages.append(current)
+            current = []
+        current.append(escaped)
+    if current:
+        messages.append(current)
+    
+    # The header goes on the first message only
+    return [
+        (f"{header}\n\n" if position == 0 else "") + "<pre>" + "\n\n".join(message) + "</pre>"
+        for position, message in enumerate(messages)
+    ]
+
+# ===== JOB COST MODEL =====
+# Untrained fallback per stage: (fixed seconds, MB/s), typical speeds for ETAs
+# and ordering. Timeouts never go below PROCESS_TIMEOUT until ffmpeg has samples.
+DEFAULT_STAGE_COSTS = {
+    'get_file': (1.0, None),
+    'local_file': (0.1, None),
+    'download_to_drive': (2.0, 10.0),
+    'ffprobe': (1.0, None),
+    'ffmpeg': (2.0, 20.0),
+    'send_document': (2.0, 8.0),
+    'send_media_group': (2.0, 8.0)
+}
+
+def solve_linear_system(matrix: List[List[float]], vector: List[float]) -> Optional[List[float]]:
+    """Gaussian elimination with partial pivoting; None if the system is singular"""
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-9:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    
+    solution = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        solution[r] = (rows[r][n] - sum(rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return solution
+
+class JobCostModel:
+    """Predicts how long each pipeline stage takes, learned from finished traces.
+
+    Every stage is fitted per container as seconds = a + b * MB + c * tracks.
+    With too few samples it uses the median seconds per MB, and for stages it
+    has never seen, DEFAULT_STAGE_COSTS.
+    """
+
+    def __init__(self, max_samples: int, min_samples: int):
+        self.min_samples = min_samples
+        # (stage, container or '*') -> (MB, track count, seconds)
+        self.samples: Dict[Tuple[str, str], deque] = defaultdict(lambda: deque(maxlen=max_samples))
+        self._fits: Dict[Tuple[str, str], Optional[List[float]]] = {}
+
+    def record(self, trace: Dict):
+        """Learn from a finished trace (in the trace log format)"""
+        meta = trace.get('meta')
+        if not meta:
+            return  # Job failed before the probe, or the trace predates the cost model
+        
+        container = meta.get('container') or 'other'
+        tracks = meta.get('tracks', 0)
+        for span in trace.get('spans', []):
+            if span.get('duration') is None or span.get('error'):
+                continue
+            # Failed jobs only count where ffmpeg hit its timeout: that duration is
+            # a lower bound, and learning it gives the next similar job more time
+            if trace.get('status') != 'ok' and not span.get('timed_out'):
+                continue
+            
+            size = span.get('bytes') or span.get('size') or meta.get('file_size') or 0
+            sample = (size / (1024 * 1024), tracks, span['duration'])
+            for key in ((span['name'], container), (span['name'], '*')):
+                self.samples[key].append(sample)
+                self._fits.pop(key, None)
+
+    def load_history(self):
+        """Replay the trace log files, oldest first (blocking)"""
+        log_files = [f"{TRACE_LOG_FILE}.{i}" for i in range(TRACE_LOG_BACKUPS, 0, -1)] + [TRACE_LOG_FILE]
+        loaded = 0
+        for log_file in log_files:
+            if not os.path.exists(log_file):
+                continue
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            self.record(json.loads(line))
+                        except ValueError:
+                            continue
+                        loaded += 1
+            except OSError as e:
+                logger.error(f"Error reading trace log {log_file}: {e}")
+        logger.info(f"Cost model trained on {loaded} traces")
+
+    def _fit(self, key: Tuple[str, str]) -> Optional[List[float]]:
+        """Least squares [a, b, c] for a sample bucket, cached until it changes"""
+        if key in self._fits:
+            return self._fits[key]
+        
+        samples = self.samples.get(key) or ()
+        coefficients = None
+        if len(samples) >= self.min_samples:
+            xtx = [[0.0] * 3 for _ in range(3)]
+            xty = [0.0] * 3
+            for mb, tracks, seconds in samples:
+                row = (1.0, mb, tracks)
+                for i in range(3):
+                    xty[i] += row[i] * seconds
+                    for j in range(3):
+                        xtx[i][j] += row[i] * row[j]
+            # Small ridge penalty on the slopes, so buckets where every file has
+            # the same size or track count still give a sane fit
+            for i in (1, 2):
+                xtx[i][i] += 0.1 * len(samples)
+            coefficients = solve_linear_system(xtx, xty)
+            if coefficients is not None and coefficients[1] < 0:
+                coefficients = None  # Bigger files never get faster
+        
+        self._fits[key] = coefficients
+        return coefficients
+
+    def predict_stage(self, stage: str, size_bytes: int, container: Optional[str] = None, tracks: int = 0) -> float:
+        """Predicted seconds for one stage of a job"""
+        mb = size_bytes / (1024 * 1024)
+        keys = [(stage, container), (stage, '*')] if container else [(stage, '*')]
+        
+        for key in keys:
+            coefficients = self._fit(key)
+            if coefficients is not None:
+                return max(coefficients[0] + coefficients[1] * mb + coefficients[2] * tracks, 0.0)
+        
+        for key in keys:
+            samples = self.samples.get(key)
+            if samples:
+                return statistics.median(seconds / max(m, 1.0) for m, _, seconds in samples) * max(mb, 1.0)
+        
+        fixed, mb_per_s = DEFAULT_STAGE_COSTS.get(stage, (1.0, None))
+        return fixed + (mb / mb_per_s if mb_per_s else 0.0)
+
+    def predict(self, stages: List[str], size_bytes: int, container: Optional[str] = None, tracks: int = 0) -> Dict[str, float]:
+        """Predicted seconds per stage, plus their 'total'"""
+        prediction = {stage: self.predict_stage(stage, size_bytes, container, tracks) for stage in stages}
+        prediction['total'] = sum(prediction.values())
+        return prediction
+
+    def has_samples(self, stage: str, container: Optional[str] = None) -> bool:
+        """Whether predict_stage() learned this stage, rather than using the defaults"""
+        keys = [(stage, container), (stage, '*')] if container else [(stage, '*')]
+        return any(self.samples.get(key) for key in keys)
+
+    def sample_count(self) -> int:
+        return sum(len(samples) for (_, container), samples in self.samples.items() if container == '*')
+
+cost_model = JobCostModel(COST_MODEL_SAMPLES, COST_MODEL_MIN_SAMPLES)
+
+def job_stages(job: Dict, downloaded: bool = False) -> List[str]:
+    """Pipeline stages a job still has to go through"""
+    stages = [] if downloaded else ['get_file', 'local_file' if LOCAL_MODE else 'download_to_drive']
+    stages += ['ffprobe', 'ffmpeg']
+    if job['kind'] == 'remove_all' or job['audio_tracks'] or job['subtitle_tracks']:
+        stages.append('send_document')
+    if job.get('extract_tracks'):
+        stages.append('send_media_group')
+    return stages
+
+def job_timeout(predicted_seconds: float, trained: bool = True) -> float:
+    """ffmpeg timeout for a job: a safety multiple of its predicted duration.
+    
+    An untrained prediction is only a guess, so it never cuts the timeout
+    below the fixed PROCESS_TIMEOUT.
+    """
+    floor = TIMEOUT_MIN if trained else PROCESS_TIMEOUT
+    return min(max(predicted_seconds * TIMEOUT_SAFETY_FACTOR + TIMEOUT_SLACK, floor), TIMEOUT_MAX)
+
+def format_eta(seconds: float) -> str:
+    """Short duration like 45s, 3m 20s or 1h 05m"""
+    seconds = max(int(round(seconds)), 1)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+class JobScheduler:
+    """Hands the MAX_CONCURRENT_PROCESSES slots to local jobs, shortest predicted first.
+
+    Waiting jobs age: each second in the queue counts as SCHEDULER_AGING seconds
+    less work, so big files are delayed but never starved. All waiters age at
+    the same rate, so the order can be fixed when a job is queued. Jobs of a
+    user already at USER_MAX_CONCURRENT_JOBS are skipped until one finishes.
+    """
+
+    def __init__(self):
+        self._waiting: List[Tuple[float, int, float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, future in self._waiting if not future.done())
+
+    def has_free_slot(self, user_id: int) -> bool:
+        return (
+            current_processes < MAX_CONCURRENT_PROCESSES
+            and not self.waiting
+            and get_user_quota(user_id).running.available() >= 1
+        )
+
+    def queue_estimate(self, predicted_seconds: float) -> Tuple[int, float]:
+        """Jobs that would run before a new job, and roughly how long it waits"""
+        priority = predicted_seconds + time.monotonic() * SCHEDULER_AGING
+        ahead = [
+            predicted for other_priority, _, predicted, _, future in self._waiting
+            if other_priority <= priority and not future.done()
+        ]
+        return len(ahead), sum(ahead) / MAX_CONCURRENT_PROCESSES
+
+    async def acquire(self, predicted_seconds: float, user_id: int):
+        """Wait for a processing slot, counted as one of the user's queued jobs meanwhile"""
+        future = asyncio.get_running_loop().create_future()
+        priority = predicted_seconds + time.monotonic() * SCHEDULER_AGING
+        get_user_quota(user_id).queued.take()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), predicted_seconds, user_id, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                self.release(user_id)  # The slot was granted just before the cancel
+            else:
+                get_user_quota(user_id).queued.give_back()
+            raise
+
+    def release(self, user_id: int):
+        """Give a slot back to the next waiting job"""
+        global current_processes
+        current_processes -= 1
+        get_user_quota(user_id).running.give_back()
+        self._dispatch()
+
+    def _dispatch(self):
+        global current_processes
+        deferred = []
+        while self._waiting and current_processes < MAX_CONCURRENT_PROCESSES:
+            entry = heapq.heappop(self._waiting)
+            *_, user_id, future = entry
+            if future.done():
+                continue  # Cancelled while waiting
+            
+            quota = get_user_quota(user_id)
+            if not quota.running.try_take():
+                deferred.append(entry)  # User at their concurrency limit
+                continue
+            
+            quota.queued.give_back()
+            current_processes += 1
+            future.set_result(None)
+        
+        for entry in deferred:
+            heapq.heappush(self._waiting, entry)
+
+scheduler = JobScheduler()
+
+# ===== EVENT LOOP WATCHDOG =====
+class LoopWatchdog:
+    """Measures event loop lag and logs the stack of whatever blocks the loop"""
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop_thread_id: Optional[int] = None
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.total_stall_time = 0.0
+        self.last_stall_at: Optional[datetime] = None
+        self.last_stall_stack = ''
+        self._last_beat = time.monotonic()
+        self._stall_captured = False
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the heartbeat task and monitor thread (call from the event loop)"""
+        self.loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - expected
+            self._last_beat = time.monotonic()
+            self._stall_captured = False
+            
+            if lag > self.threshold:
+                self.stalls += 1
+                self.total_stall_time += lag
+                self.max_lag = max(self.max_lag, lag)
+                self.last_stall_at = datetime.now()
+                logger.warning(f"Event loop stalled for {lag:.2f}s")
+
+    def _monitor(self):
+        """Runs in a thread: grabs the loop thread's stack while it is blocked"""
+        while not self._stop.wait(self.interval):
+            blocked_for = time.monotonic() - self._last_beat
+            if blocked_for < self.threshold or self._stall_captured:
+                continue
+            
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            self._stall_captured = True
+            self.last_stall_stack = ''.join(traceback.format_stack(frame))
+            logger.warning(
+                f"Event loop blocked for {blocked_for:.2f}s, current stack:\n{self.last_stall_stack}"
+            )
+
+    def summary(self) -> str:
+        """One line of stall statistics for /status"""
+        text = (
+            f"🐢 Loop stalls: {self.stalls} | "
+            f"max {self.max_lag:.2f}s | total {self.total_stall_time:.1f}s"
+        )
+        if self.last_stall_at:
+            text += f" | last {self.last_stall_at.strftime('%H:%M:%S')}"
+        return text
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_STALL_THRESHOLD)
+
+def sample_profile(seconds: float, interval: float) -> Tuple[str, int]:
+    """Sample the stacks of all threads and return them in folded (flamegraph) format"""
+    own_thread_id = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        thread_names[loop_watchdog.loop_thread_id] = "event-loop"
+        
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(stack))] += 1
+        
+        samples += 1
+        time.sleep(interval)
+    
+    folded = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    return folded, samples
+
+def summarize_profile(folded: str, limit: int = 5) -> str:
+    """Hottest leaf frames of the event loop thread"""
+    leaves = Counter()
+    total = 0
+    for line in folded.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        frames = stack.split(';')
+        if frames[0] != "event-loop":
+            continue
+        leaves[frames[-1]] += int(count)
+        total += int(count)
+    
+    if not total:
+        return ""
+    return "\n".join(f"{count * 100 / total:5.1f}% {frame}" for frame, count in leaves.most_common(limit))
+
 # ===== UTILITY FUNCTIONS =====
 def is_admin(user_id: int) -> bool:
     """Check if user is admin"""
@@ -120,19 +1042,72 @@ def is_authorized(user_id: int) -> bool:
     """Check if user is authorized based on bot mode"""
     return is_admin(user_id)  # Always private mode
 
+# Only the probe fields the bot reads, when ffprobe supports -show_entries
+PROBE_ENTRIES = (
+    "format=format_name,duration,size:format_tags=major_brand:"
+    "stream=index,codec_type,codec_name,channels:stream_tags=language,title"
+)
+
 def get_video_info(file_path: str) -> Dict:
-    """Get video information using ffprobe - OPTIMIZED"""
+    """Get video information - parsed in-process for MKV/MP4, ffprobe otherwise"""
+    if NATIVE_PROBE_ENABLED:
+        info = parse_container(file_path)
+        if info:
+            return info
     try:
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json',
-            '-show_streams', '-show_format', file_path
-        ]
+        if ffmpeg_capabilities.get('show_entries', False):
+            cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_entries', PROBE_ENTRIES, file_path]
+        else:
+            cmd = [
+                'ffprobe', '-v', 'quiet', '-print_format', 'json',
+                '-show_streams', '-show_format', file_path
+            ]
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
         return json.loads(result.stdout)
     except Exception as e:
         logger.error(f"Error getting video info: {e}")
         return {}
 
+def has_packet_counts(info: Optional[Dict]) -> bool:
+    """Whether a probe result already holds every stream's packet count (MP4 sample tables)"""
+    streams = (info or {}).get('streams')
+    return bool(streams) and all('nb_read_packets' in stream for stream in streams)
+
+async def count_packets(file_path: str, timeout: float) -> Optional[Dict]:
+    """Streams with packet counts, read from the sample tables where the container has them.
+    
+    Anything else is counted by probe_packets, a full read of the file.
+    """
+    if NATIVE_PROBE_ENABLED:
+        info = await asyncio.to_thread(parse_container, file_path)
+        if has_packet_counts(info):
+            return info
+    return await probe_packets(file_path, timeout)
+
+async def probe_packets(file_path: str, timeout: float) -> Optional[Dict]:
+    """Streams with demuxed packet counts (ffprobe -count_packets, nothing is decoded).
+    
+    Reads the whole file, so it runs isolated like ffmpeg. Returns None if the
+    probe could not finish in time, {} if the file could not be read.
+    """
+    cmd = ['ffprobe', '-v', 'quiet', '-count_packets', '-print_format', 'json']
+    if ffmpeg_capabilities.get('show_entries', False):
+        cmd += [
+            '-show_entries',
+            'format=duration:stream=index,codec_type,duration,nb_read_packets:stream_tags=language'
+        ]
+    else:
+        cmd += ['-show_streams', '-show_format']
+    try:
+        _, stdout, _ = await run_isolated(cmd + [file_path], timeout, capture_stdout=True)
+        return json.loads(stdout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Packet count of {file_path} timed out after {timeout:.0f}s")
+        return None
+    except Exception as e:
+        logger.error(f"Error counting packets: {e}")
+        return {}
+
 def get_audio_tracks(video_info: Dict) -> List[Dict]:
     """Extract audio tracks information"""
     audio_tracks = []
@@ -194,55 +1169,2332 @@ def get_subtitle_tracks(video_info: Dict) -> List[Dict]:
     
     return subtitle_tracks
 
-def remove_tracks(input_path: str, output_path: str, audio_tracks_to_remove: Set[int], subtitle_tracks_to_remove: Set[int]) -> bool:
-    """Remove specified audio and subtitle tracks using ffmpeg - OPTIMIZED FOR SPEED"""
-    try:
-        # Build optimized ffmpeg command for speed
-        cmd = [
-            'ffmpeg', 
-            '-i', input_path, 
-            '-c', 'copy',  # Stream copy for maximum speed
-            '-y'  # Overwrite output file
-        ]
-        
-        # Map all streams by default
-        cmd.extend(['-map', '0'])
-        
-        # Remove specified audio tracks
-        for audio_index in audio_tracks_to_remove:
-            cmd.extend(['-map', f'-0:a:{audio_index}'])
-        
-        # Remove specified subtitle tracks
-        for sub_index in subtitle_tracks_to_remove:
-            cmd.extend(['-map', f'-0:s:{sub_index}'])
-        
-        cmd.append(output_path)
-        
-        # Run ffmpeg with timeout
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROCESS_TIMEOUT)
-        
-        if result.returncode == 0:
-            return True
-        else:
-            logger.error(f"FFmpeg error: {result.stderr}")
-            return False
-            
-    except subprocess.TimeoutExpired:
-        logger.error("FFmpeg process timed out")
-        return False
-    except Exception as e:
-        logger.error(f"Error in remove_tracks: {e}")
-        return False
+# ===== CONTAINER PARSER =====
+# Reads the track tables of Matroska and MP4/MOV files in-process, so a probe
+# does not have to spawn ffprobe. The result has the ffprobe JSON shape for the
+# PROBE_ENTRIES fields. Anything not recognized returns {} and ffprobe is used.
+
+MKV_EBML = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEKHEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_NAME = 0x536E
+MKV_LANGUAGE = 0x22B59C
+MKV_LANGUAGE_BCP47 = 0x22B59D
+MKV_AUDIO = 0xE1
+MKV_CHANNELS = 0x9F
+MKV_BIT_DEPTH = 0x6264
+MKV_ATTACHMENTS = 0x1941A469
+MKV_ATTACHED_FILE = 0x61A7
+MKV_FILE_NAME = 0x466E
+MKV_FILE_MIME_TYPE = 0x4660
+MKV_CLUSTER = 0x1F43B675
+MKV_UNKNOWN_SIZE = -1
+
+MKV_TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitle'}
+# Matroska CodecID -> ffmpeg codec name (A_PCM/* is handled by bit depth)
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_AV1': 'av1',
+    'V_VP9': 'vp9', 'V_VP8': 'vp8', 'V_MPEG4/ISO/SP': 'mpeg4', 'V_MPEG4/ISO/ASP': 'mpeg4',
+    'V_MPEG4/ISO/AP': 'mpeg4', 'V_MPEG2': 'mpeg2video', 'V_MPEG1': 'mpeg1video',
+    'V_MJPEG': 'mjpeg', 'V_THEORA': 'theora', 'V_PRORES': 'prores',
+    'A_AC3': 'ac3', 'A_EAC3': 'eac3', 'A_DTS': 'dts', 'A_TRUEHD': 'truehd',
+    'A_FLAC': 'flac', 'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_ALAC': 'alac',
+    'A_MPEG/L3': 'mp3', 'A_MPEG/L2': 'mp2', 'A_MPEG/L1': 'mp1',
+    'S_TEXT/UTF8': 'subrip', 'S_TEXT/ASS': 'ass', 'S_TEXT/SSA': 'ass', 'S_ASS': 'ass',
+    'S_SSA': 'ass', 'S_TEXT/WEBVTT': 'webvtt', 'S_HDMV/PGS': 'hdmv_pgs_subtitle',
+    'S_VOBSUB': 'dvd_subtitle', 'S_DVBSUB': 'dvb_subtitle', 'S_HDMV/TEXTST': 'hdmv_text_subtitle'
+}
+# Attachment MIME type -> (codec_type, codec_name); images become cover art streams
+MKV_ATTACHMENT_CODECS = {
+    'image/jpeg': ('video', 'mjpeg'), 'image/png': ('video', 'png'),
+    'application/x-truetype-font': ('attachment', 'ttf'), 'application/x-font-ttf': ('attachment', 'ttf'),
+    'font/ttf': ('attachment', 'ttf'), 'font/sfnt': ('attachment', 'ttf'),
+    'application/vnd.ms-opentype': ('attachment', 'otf'), 'application/x-font-otf': ('attachment', 'otf'),
+    'font/otf': ('attachment', 'otf')
+}
+
+MP4_HANDLERS = {'vide': 'video', 'soun': 'audio', 'sbtl': 'subtitle', 'text': 'subtitle'}
+# Sample entry type -> ffmpeg codec name ('mp4a'/'mp4v' are resolved from esds)
+MP4_SAMPLE_ENTRIES = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1',
+    'vp09': 'vp9', 'jpeg': 'mjpeg', 'png ': 'png', 'apch': 'prores', 'apcn': 'prores',
+    'apcs': 'prores', 'apco': 'prores', 'ap4h': 'prores',
+    'ac-3': 'ac3', 'ec-3': 'eac3', 'Opus': 'opus', 'fLaC': 'flac', 'alac': 'alac',
+    'dtsc': 'dts', 'dtsh': 'dts', 'dtsl': 'dts', '.mp3': 'mp3',
+    'sowt': 'pcm_s16le', 'twos': 'pcm_s16be', 'in24': 'pcm_s24be', 'in32': 'pcm_s32be',
+    'fl32': 'pcm_f32be', 'fl64': 'pcm_f64be', 'tx3g': 'mov_text'
+}
+# esds objectTypeIndication -> ffmpeg codec name
+MP4_OBJECT_TYPES = {
+    0x20: 'mpeg4', 0x40: 'aac', 0x66: 'aac', 0x67: 'aac', 0x68: 'aac', 0x69: 'mp3',
+    0x6B: 'mp3', 0x60: 'mpeg2video', 0x61: 'mpeg2video', 0x6A: 'mpeg1video',
+    0x6C: 'mjpeg', 0xA5: 'ac3', 0xA6: 'eac3', 0xA9: 'dts'
+}
+
+class ContainerParseError(Exception):
+    """The file is truncated, malformed or uses something the parser or rewriter does not handle"""
+
+def ebml_vint(data, pos: int, end: int, keep_marker: bool) -> Tuple[int, int]:
+    """Read an EBML variable-size integer, returns (value, next position)"""
+    if pos >= end:
+        raise ContainerParseError("truncated")
+    first = data[pos]
+    length = 8 - first.bit_length() + 1
+    if first == 0 or pos + length > end:
+        raise ContainerParseError("bad vint")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = MKV_UNKNOWN_SIZE
+    return value, pos + length
+
+def ebml_children(data, pos: int, end: int):
+    """Yield (id, data start, data end) for the elements in data[pos:end]"""
+    while pos < end:
+        element_id, pos = ebml_vint(data, pos, end, True)
+        size, pos = ebml_vint(data, pos, end, False)
+        child_end = end if size == MKV_UNKNOWN_SIZE else pos + size
+        yield element_id, pos, child_end
+        if size == MKV_UNKNOWN_SIZE:
+            return  # Only the last element (a live Segment or Cluster) can be open-ended
+        pos = child_end
+
+def ebml_fields(data, start: int, end: int) -> Dict[int, Tuple[int, int]]:
+    """Child element id -> (data start, data end), first occurrence wins"""
+    fields = {}
+    for element_id, child_start, child_end in ebml_children(data, start, end):
+        fields.setdefault(element_id, (child_start, child_end))
+    return fields
+
+def ebml_uint(data, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], 'big')
+
+def ebml_string(data, start: int, end: int) -> str:
+    return bytes(data[start:end]).rstrip(b'\0').decode('utf-8', errors='replace')
+
+def parse_matroska(data, available: int) -> Dict:
+    """Track table of a Matroska/WebM file (only the headers have to be present)"""
+    elements = ebml_children(data, 0, available)
+    if next(elements)[0] != MKV_EBML:
+        raise ContainerParseError("no EBML header")
+    for element_id, segment_start, segment_end in elements:
+        if element_id == MKV_SEGMENT:
+            break
+    else:
+        raise ContainerParseError("no segment")
+    segment_end = min(segment_end, available)
+    
+    # Walk the headers up to the first Cluster (or the end of a partial file),
+    # then use the SeekHead for whatever comes later
+    found, seeks = {}, {}
+    try:
+        for element_id, start, end in ebml_children(data, segment_start, segment_end):
+            if element_id == MKV_CLUSTER or end > available:
+                break
+            if element_id in (MKV_INFO, MKV_TRACKS, MKV_ATTACHMENTS):
+                found.setdefault(element_id, (start, end))
+            elif element_id == MKV_SEEKHEAD:
+                for seek_id, seek_start, seek_end in ebml_children(data, start, end):
+                    if seek_id != MKV_SEEK:
+                        continue
+                    fields = ebml_fields(data, seek_start, seek_end)
+                    if MKV_SEEK_ID in fields and MKV_SEEK_POSITION in fields:
+                        target = ebml_uint(data, *fields[MKV_SEEK_ID])
+                        seeks.setdefault(target, segment_start + ebml_uint(data, *fields[MKV_SEEK_POSITION]))
+    except ContainerParseError:
+        pass  # Cut off inside an element header
+    for element_id in (MKV_INFO, MKV_TRACKS, MKV_ATTACHMENTS):
+        if element_id not in found and element_id in seeks:
+            target_id, start, end = next(ebml_children(data, seeks[element_id], available))
+            if target_id != element_id or end > available:
+                raise ContainerParseError("seek target not readable")
+            found[element_id] = (start, end)
+    if MKV_TRACKS not in found:
+        raise ContainerParseError("no tracks")
+    
+    fmt = {'format_name': 'matroska,webm'}
+    if MKV_INFO in found:
+        scale, duration = 1000000, None
+        for element_id, start, end in ebml_children(data, *found[MKV_INFO]):
+            if element_id == MKV_TIMESTAMP_SCALE:
+                scale = ebml_uint(data, start, end)
+            elif element_id == MKV_DURATION:
+                duration = struct.unpack('>f' if end - start == 4 else '>d', data[start:end])[0]
+        if duration is not None:
+            fmt['duration'] = f"{duration * scale / 1e9:.6f}"
+    
+    streams = []
+    for element_id, start, end in ebml_children(data, *found[MKV_TRACKS]):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        fields = ebml_fields(data, start, end)
+        codec_type = MKV_TRACK_TYPES.get(ebml_uint(data, *fields[MKV_TRACK_TYPE]) if MKV_TRACK_TYPE in fields else 0)
+        codec_id = ebml_string(data, *fields[MKV_CODEC_ID]) if MKV_CODEC_ID in fields else ''
+        audio = {}
+        if MKV_AUDIO in fields:
+            audio = {child: ebml_uint(data, *span) for child, span in ebml_fields(data, *fields[MKV_AUDIO]).items()}
+        bit_depth = audio.get(MKV_BIT_DEPTH, 16)
+        if codec_id.startswith('A_AAC'):
+            codec_name = 'aac'
+        elif codec_id == 'A_PCM/INT/LIT':
+            codec_name = 'pcm_u8' if bit_depth == 8 else f"pcm_s{bit_depth}le"
+        elif codec_id == 'A_PCM/INT/BIG':
+            codec_name = f"pcm_s{bit_depth}be"
+        elif codec_id == 'A_PCM/FLOAT/IEEE':
+            codec_name = f"pcm_f{bit_depth if bit_depth in (32, 64) else 32}le"
+        else:
+            codec_name = MKV_CODECS.get(codec_id)
+        if not codec_type or not codec_name:
+            raise ContainerParseError(f"unmapped track {codec_id!r}")
+        
+        stream = {'index': len(streams), 'codec_name': codec_name, 'codec_type': codec_type, 'tags': {}}
+        if codec_type == 'audio':
+            stream['channels'] = audio.get(MKV_CHANNELS, 1)
+        # Like ffmpeg: a missing Language means English, "und" gets no tag
+        if MKV_LANGUAGE in fields:
+            language = ebml_string(data, *fields[MKV_LANGUAGE])
+        elif MKV_LANGUAGE_BCP47 in fields:
+            language = ebml_string(data, *fields[MKV_LANGUAGE_BCP47])
+        else:
+            language = 'eng'
+        if language and language != 'und':
+            stream['tags']['language'] = language
+        if MKV_NAME in fields:
+            stream['tags']['title'] = ebml_string(data, *fields[MKV_NAME])
+        streams.append(stream)
+    
+    # ffmpeg lists attachments after the tracks
+    if MKV_ATTACHMENTS in found:
+        for element_id, start, end in ebml_children(data, *found[MKV_ATTACHMENTS]):
+            if element_id != MKV_ATTACHED_FILE:
+                continue
+            fields = ebml_fields(data, start, end)
+            mime_type = ebml_string(data, *fields[MKV_FILE_MIME_TYPE]) if MKV_FILE_MIME_TYPE in fields else ''
+            if mime_type.startswith('image/') and mime_type not in MKV_ATTACHMENT_CODECS:
+                raise ContainerParseError(f"unmapped attachment {mime_type!r}")
+            codec_type, codec_name = MKV_ATTACHMENT_CODECS.get(mime_type, ('attachment', None))
+            stream = {'index': len(streams), 'codec_type': codec_type, 'tags': {}}
+            if codec_name:
+                stream['codec_name'] = codec_name
+            if MKV_FILE_NAME in fields:
+                stream['tags']['filename'] = ebml_string(data, *fields[MKV_FILE_NAME])
+            streams.append(stream)
+    
+    return {'streams': streams, 'format': fmt}
+
+def mp4_boxes(data, pos: int, end: int):
+    """Yield (type, data start, box end) for the boxes in data[pos:end]"""
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise ContainerParseError("truncated")
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos  # Runs to the end of the file
+        if size < header:
+            raise ContainerParseError("bad box size")
+        yield box_type.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def mp4_child(data, start: int, end: int, path: str) -> Optional[Tuple[int, int]]:
+    """Find a nested box by a path like 'mdia/minf/stbl'"""
+    for name in path.split('/'):
+        for box_type, child_start, child_end in mp4_boxes(data, start, end):
+            if box_type == name:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return start, end
+
+def mp4_language(code: int) -> Optional[str]:
+    """ISO-639-2/T from the packed mdhd language (0 is the Mac code for English)"""
+    if code == 0:
+        return 'eng'
+    if code < 0x400 or code == 0x7FFF:
+        return None
+    return ''.join(chr(((code >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+def mp4_object_type(data, start: int, end: int) -> Optional[int]:
+    """objectTypeIndication from an esds box (inside a sample entry)"""
+    esds = None
+    for box_type, box_start, box_end in mp4_boxes(data, start, end):
+        if box_type == 'esds':
+            esds = (box_start + 4, box_end)  # Skip version/flags
+    if not esds:
+        return None
+    # Descriptors: tag, size as up to 4 bytes of 7 bits; ES_Descriptor (3) holds DecoderConfig (4)
+    pos, end = esds
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        for _ in range(4):
+            more = data[pos] & 0x80
+            pos += 1
+            if not more:
+                break
+        if tag == 3:
+            flags = data[pos + 2]
+            pos += 3
+            if flags & 0x80:
+                pos += 2  # dependsOn_ES_ID
+            if flags & 0x40:
+                pos += 1 + data[pos]  # URL
+            if flags & 0x20:
+                pos += 2  # OCR_ES_Id
+        elif tag == 4:
+            return data[pos]
+        else:
+            return None
+    return None
+
+def mp4_sample_count(data, start: int, end: int) -> Optional[int]:
+    """Samples in a trak, where ffmpeg demuxes one packet per sample.
+    
+    None for constant sample sizes (ffmpeg groups raw PCM samples into chunk
+    packets) and for multi-entry edit lists (it may drop whole edits).
+    """
+    elst = mp4_child(data, start, end, 'edts/elst')
+    if elst and struct.unpack_from('>I', data, elst[0] + 4)[0] > 1:
+        return None
+    stsz = mp4_child(data, start, end, 'mdia/minf/stbl/stsz')
+    if stsz:
+        sample_size, sample_count = struct.unpack_from('>II', data, stsz[0] + 4)
+        return sample_count if sample_size == 0 else None
+    stz2 = mp4_child(data, start, end, 'mdia/minf/stbl/stz2')
+    if stz2:
+        return struct.unpack_from('>I', data, stz2[0] + 8)[0]
+    return None
+
+def mp4_has_cover(data, start: int, end: int) -> bool:
+    """Whether moov holds iTunes cover art, which ffmpeg shows as an extra video stream"""
+    for path in ('udta/meta', 'meta'):
+        meta = mp4_child(data, start, end, path)
+        if not meta:
+            continue
+        children = meta[0]
+        # ISO meta is a full box (version/flags before its children), QuickTime's is not
+        if bytes(data[children + 4:children + 8]) != b'hdlr':
+            children += 4
+        if mp4_child(data, children, meta[1], 'ilst/covr'):
+            return True
+    return False
+
+def parse_mp4(data, available: int) -> Dict:
+    """Track table of an MP4/MOV file (needs the moov box to be present)"""
+    fmt = {'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'tags': {}}
+    moov = None
+    for box_type, start, end in mp4_boxes(data, 0, available):
+        if box_type == 'ftyp':
+            fmt['tags']['major_brand'] = bytes(data[start:start + 4]).decode('latin-1')
+        elif box_type == 'moov':
+            if end > available:
+                raise ContainerParseError("truncated moov")
+            moov = (start, end)
+            break
+    if not moov:
+        raise ContainerParseError("no moov")
+    if mp4_child(data, *moov, 'mvex'):
+        raise ContainerParseError("fragmented")  # Durations live in the fragments
+    if mp4_has_cover(data, *moov):
+        raise ContainerParseError("cover art")  # Its stream index depends on ffmpeg's box order
+    
+    mvhd = mp4_child(data, *moov, 'mvhd')
+    if mvhd:
+        version = data[mvhd[0]]
+        timescale, duration = struct.unpack_from('>IQ' if version == 1 else '>II', data, mvhd[0] + (20 if version == 1 else 12))
+        if timescale:
+            fmt['duration'] = f"{duration / timescale:.6f}"
+    
+    streams = []
+    for box_type, start, end in mp4_boxes(data, *moov):
+        if box_type != 'trak':
+            continue
+        if mp4_child(data, start, end, 'tref/chap'):
+            raise ContainerParseError("chapter track")
+        hdlr = mp4_child(data, start, end, 'mdia/hdlr')
+        mdhd = mp4_child(data, start, end, 'mdia/mdhd')
+        stsd = mp4_child(data, start, end, 'mdia/minf/stbl/stsd')
+        if not (hdlr and mdhd and stsd):
+            raise ContainerParseError("incomplete trak")
+        codec_type = MP4_HANDLERS.get(bytes(data[hdlr[0] + 8:hdlr[0] + 12]).decode('latin-1'))
+        
+        # First sample entry, after version/flags and the entry count
+        entry_type, entry_start, entry_end = next(mp4_boxes(data, stsd[0] + 8, stsd[1]), (None, 0, 0))
+        if entry_type in ('mp4a', 'mp4v'):
+            # Audio entries hold 28 bytes of fields before their boxes (more for QuickTime v1/v2)
+            if entry_type == 'mp4a':
+                version = struct.unpack_from('>H', data, entry_start + 8)[0]
+                skip = {0: 28, 1: 44, 2: 64}.get(version, 28)
+            else:
+                skip = 78
+            codec_name = MP4_OBJECT_TYPES.get(mp4_object_type(data, entry_start + skip, entry_end))
+        else:
+            codec_name = MP4_SAMPLE_ENTRIES.get(entry_type)
+        if not codec_type or not codec_name:
+            raise ContainerParseError(f"unmapped track {entry_type!r}")
+        
+        stream = {'index': len(streams), 'codec_name': codec_name, 'codec_type': codec_type, 'tags': {}}
+        if codec_type == 'audio':
+            version = struct.unpack_from('>H', data, entry_start + 8)[0]
+            if version == 2:
+                stream['channels'] = struct.unpack_from('>I', data, entry_start + 40)[0]
+            else:
+                stream['channels'] = struct.unpack_from('>H', data, entry_start + 16)[0]
+        version = data[mdhd[0]]
+        language = mp4_language(struct.unpack_from('>H', data, mdhd[0] + (32 if version == 1 else 20))[0])
+        if language:
+            stream['tags']['language'] = language
+        timescale, duration = struct.unpack_from('>IQ' if version == 1 else '>II', data, mdhd[0] + (20 if version == 1 else 12))
+        if timescale:
+            stream['duration'] = f"{duration / timescale:.6f}"
+        # The packet counts probe_packets would report, read from the sample table
+        sample_count = mp4_sample_count(data, start, end)
+        if sample_count is not None:
+            stream['nb_read_packets'] = str(sample_count)
+        streams.append(stream)
+    
+    return {'streams': streams, 'format': fmt}
+
+def parse_container(file_path: str) -> Dict:
+    """Probe a Matroska or MP4/MOV file without ffprobe.
+    
+    Works on a partial download as long as the headers are there. Returns {} for
+    other containers or anything the parser cannot map, so the caller uses ffprobe.
+    The result is marked with 'parser': 'native' - its stream indices are then
+    exactly the TrackEntry positions the Matroska rewriter works with.
+    """
+    try:
+        # Only the header pages get read, even when a multi-GB mdat comes first
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            available = len(data)
+            if data[:4] == b'\x1a\x45\xdf\xa3':
+                info = parse_matroska(data, available)
+            elif data[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'wide', b'skip'):
+                info = parse_mp4(data, available)
+            else:
+                return {}
+        info['format']['size'] = str(available)
+        info['parser'] = 'native'
+        return info
+    except (ContainerParseError, OSError, ValueError, IndexError, KeyError, StopIteration, struct.error) as e:
+        logger.debug(f"Container parser skipped {file_path}: {e}")
+        return {}
+
+# ===== MATROSKA REWRITER =====
+# Removing tracks from a Matroska file needs no demux/mux: clusters are copied
+# without the blocks of the removed tracks, and Tracks, Cues, Tags and the
+# SeekHead are rewritten. Every size and position this writes is 8 bytes long,
+# so the header can be laid out before the clusters are read and patched after.
+# It runs in a thread of the bot process, with the ffmpeg nice/ionice/CPU limits
+# but outside the per-job cgroup.
+
+MKV_EBML_MAX_SIZE_LENGTH = 0x42F3
+MKV_VOID = 0xEC
+MKV_CRC32 = 0xBF
+MKV_TRACK_NUMBER = 0xD7
+MKV_TRACK_UID = 0x73C5
+MKV_CLUSTER_POSITION = 0xA7
+MKV_PREV_SIZE = 0xAB
+MKV_SIMPLE_BLOCK = 0xA3
+MKV_BLOCK_GROUP = 0xA0
+MKV_BLOCK = 0xA1
+MKV_ENCRYPTED_BLOCK = 0xAF
+MKV_CUES = 0x1C53BB6B
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_TRACK = 0xF7
+MKV_CUE_CLUSTER_POSITION = 0xF1
+MKV_CUE_RELATIVE_POSITION = 0xF0
+MKV_CUE_DURATION = 0xB2
+MKV_TAGS = 0x1254C367
+MKV_TAG = 0x7373
+MKV_TARGETS = 0x63C0
+MKV_TAG_TRACK_UID = 0x63C5
+MKV_REMOVABLE_TRACK_TYPES = {2, 17}  # Audio, subtitle
+MKV_UNKNOWN_SIZE_BYTES = b'\x01' + b'\xff' * 7
+
+def ebml_id(element_id: int) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+def ebml_size(size: int) -> bytes:
+    return (size | (1 << 56)).to_bytes(8, 'big')
+
+def ebml_element(element_id: int, payload: bytes) -> bytes:
+    return ebml_id(element_id) + ebml_size(len(payload)) + payload
+
+def ebml_uint_element(element_id: int, value: int) -> bytes:
+    return ebml_element(element_id, value.to_bytes(8, 'big'))
+
+def ebml_void(length: int) -> bytes:
+    """Void element taking exactly length bytes (at least 9)"""
+    return ebml_element(MKV_VOID, bytes(length - 9))
+
+def read_exact(src, size: int) -> bytes:
+    data = src.read(size)
+    if len(data) != size:
+        raise ContainerParseError("truncated")
+    return data
+
+def read_element_header(src) -> Optional[Tuple[int, int, int]]:
+    """Read (id, size, header length) from a stream, None at a clean end"""
+    values, header_length = [], 0
+    for keep_marker in (True, False):
+        first = src.read(1)
+        if not first:
+            if keep_marker:
+                return None
+            raise ContainerParseError("truncated")
+        raw = first + read_exact(src, 8 - first[0].bit_length()) if first[0] else first
+        value, _ = ebml_vint(raw, 0, len(raw), keep_marker)
+        values.append(value)
+        header_length += len(raw)
+    return values[0], values[1], header_length
+
+class MatroskaTrackStripper:
+    """Copy a Matroska file without some of its tracks in one sequential pass.
+    
+    Works on any binary streams. When the output cannot seek, the Segment size is
+    left unknown and the SeekHead only lists the elements before the clusters.
+    Raises ContainerParseError for anything it does not handle, so the caller
+    can use ffmpeg instead.
+    """
+    
+    def __init__(self, removed_entries: Set[int]):
+        self.removed_entries = removed_entries  # TrackEntry positions = ffprobe stream indices
+        self.removed_numbers = set()
+        self.removed_uids = set()
+        self.cancelled = threading.Event()
+        self.buffer = bytearray()
+        self.written = 0
+        self.segment_start = 0
+        self.positions = {}  # Top-level element id -> new position in the Segment (first one)
+        self.clusters = {}  # Old cluster position -> (new position, first, end) in the drop arrays
+        self.drop_offsets = array('q')  # Where each dropped cluster child was, in its old cluster
+        self.drop_totals = array('q')  # Bytes dropped from that cluster up to and including it
+    
+    def write(self, dst, *chunks):
+        for chunk in chunks:
+            dst.write(chunk)
+            self.written += len(chunk)
+    
+    def segment_children(self, src, segment_size: int):
+        """Yield (id, size, old position) - the payload must be consumed before the next one"""
+        position = 0
+        while segment_size == MKV_UNKNOWN_SIZE or position < segment_size:
+            if self.cancelled.is_set():
+                raise ContainerParseError("cancelled")
+            header = read_element_header(src)
+            if header is None:
+                if segment_size != MKV_UNKNOWN_SIZE:
+                    raise ContainerParseError("truncated segment")
+                return
+            element_id, size, header_length = header
+            if size == MKV_UNKNOWN_SIZE or size > NATIVE_REMUX_MAX_ELEMENT:
+                raise ContainerParseError(f"element {element_id:#x} of unknown or huge size")
+            yield element_id, size, position
+            position += header_length + size
+    
+    def run(self, src, dst) -> int:
+        """Rewrite src into dst, returns the number of bytes written"""
+        header = read_element_header(src)
+        if not header or header[0] != MKV_EBML:
+            raise ContainerParseError("no EBML header")
+        payload = read_exact(src, header[1])
+        max_size_length = ebml_fields(payload, 0, len(payload)).get(MKV_EBML_MAX_SIZE_LENGTH)
+        if max_size_length and ebml_uint(payload, *max_size_length) < 8:
+            raise ContainerParseError("8-byte sizes not allowed")
+        self.write(dst, ebml_element(MKV_EBML, payload))
+        header = read_element_header(src)
+        if not header or header[0] != MKV_SEGMENT:
+            raise ContainerParseError("no segment")
+        children = self.segment_children(src, header[1])
+        
+        # Everything before the first cluster is small: collect it to lay out the new header
+        head, seek_targets = [], set()
+        for element_id, size, position in children:
+            if element_id == MKV_CLUSTER:
+                break
+            payload = read_exact(src, size)
+            if element_id == MKV_SEEKHEAD:
+                for seek_id, start, end in ebml_children(payload, 0, size):
+                    fields = ebml_fields(payload, start, end) if seek_id == MKV_SEEK else {}
+                    if MKV_SEEK_ID in fields:
+                        seek_targets.add(ebml_uint(payload, *fields[MKV_SEEK_ID]))
+            elif element_id == MKV_CUES:
+                raise ContainerParseError("cues before the clusters")
+            elif element_id == MKV_TRACKS:
+                head.append((element_id, ebml_element(element_id, self.rewrite_tracks(payload))))
+            elif element_id == MKV_TAGS:
+                payload = self.rewrite_tags(payload)
+                if payload:
+                    head.append((element_id, ebml_element(element_id, payload)))
+            elif element_id not in (MKV_VOID, MKV_CRC32):
+                head.append((element_id, ebml_element(element_id, payload)))
+        else:
+            raise ContainerParseError("no clusters")
+        if not self.removed_numbers:
+            raise ContainerParseError("no tracks")
+        
+        # SeekHead room for every element that can be indexed, patched at the end
+        seekable = dst.seekable()
+        targets = {element_id for element_id, _ in head}
+        if seekable:
+            targets |= (seek_targets | {MKV_CUES}) - {MKV_SEEKHEAD, MKV_CLUSTER, MKV_VOID, MKV_CRC32}
+        reserved = len(self.seekhead(dict.fromkeys(targets, 0)))
+        offset = reserved
+        for element_id, element in head:
+            self.positions.setdefault(element_id, offset)
+            offset += len(element)
+        
+        self.write(dst, ebml_id(MKV_SEGMENT))
+        segment_size_offset = self.written
+        self.write(dst, MKV_UNKNOWN_SIZE_BYTES)
+        self.segment_start = self.written
+        self.write(dst, self.seekhead_block(targets, reserved))
+        self.write(dst, *(element for _, element in head))
+        
+        self.copy_cluster(src, dst, size, position)
+        for element_id, size, position in children:
+            if element_id == MKV_CLUSTER:
+                self.copy_cluster(src, dst, size, position)
+                continue
+            payload = read_exact(src, size)
+            if element_id == MKV_TRACKS:
+                raise ContainerParseError("tracks after the clusters")
+            if element_id in (MKV_SEEKHEAD, MKV_VOID, MKV_CRC32):
+                continue
+            if element_id == MKV_CUES:
+                payload = self.rewrite_cues(payload)
+            elif element_id == MKV_TAGS:
+                payload = self.rewrite_tags(payload)
+            if not payload:
+                continue
+            self.positions.setdefault(element_id, self.written - self.segment_start)
+            self.write(dst, ebml_element(element_id, payload))
+        
+        if seekable:
+            end = self.written
+            dst.seek(segment_size_offset)
+            dst.write(ebml_size(end - self.segment_start))
+            dst.write(self.seekhead_block(targets, reserved))
+            dst.seek(end)
+        return self.written
+    
+    def strip_file(self, input_path: str, output_path: str) -> int:
+        lower_thread_priority()
+        with open(input_path, 'rb', buffering=1024 * 1024) as src, open(output_path, 'wb', buffering=1024 * 1024) as dst:
+            return self.run(src, dst)
+    
+    def seekhead(self, positions: Dict[int, int]) -> bytes:
+        return ebml_element(MKV_SEEKHEAD, b''.join(
+            ebml_element(MKV_SEEK, ebml_element(MKV_SEEK_ID, ebml_id(target)) + ebml_uint_element(MKV_SEEK_POSITION, position))
+            for target, position in positions.items()
+        ))
+    
+    def seekhead_block(self, targets: Set[int], reserved: int) -> bytes:
+        """SeekHead of the elements written so far, padded with Void to the reserved size"""
+        seekhead = self.seekhead({target: self.positions[target] for target in targets if target in self.positions})
+        return seekhead + (ebml_void(reserved - len(seekhead)) if len(seekhead) < reserved else b'')
+    
+    def copy_cluster(self, src, dst, size: int, old_position: int):
+        """Copy one cluster without the removed tracks' blocks (slices of one read buffer)"""
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)[:size]
+        if src.readinto(view) != size:
+            raise ContainerParseError("truncated cluster")
+        
+        kept, dropped, first = [], 0, len(self.drop_offsets)
+        pos = 0
+        while pos < size:
+            element_id, data_start = ebml_vint(view, pos, size, True)
+            length, data_start = ebml_vint(view, data_start, size, False)
+            end = data_start + length
+            if length == MKV_UNKNOWN_SIZE or end > size:
+                raise ContainerParseError("bad cluster child")
+            if self.keep_cluster_child(view, element_id, data_start, end):
+                kept.append(view[pos:end])
+            else:
+                dropped += end - pos
+                self.drop_offsets.append(pos)
+                self.drop_totals.append(dropped)
+            pos = end
+        
+        self.clusters[old_position] = (self.written - self.segment_start, first, len(self.drop_offsets))
+        self.write(dst, ebml_id(MKV_CLUSTER) + ebml_size(size - dropped), *kept)
+    
+    def keep_cluster_child(self, view, element_id: int, start: int, end: int) -> bool:
+        if element_id in (MKV_CLUSTER_POSITION, MKV_PREV_SIZE, MKV_CRC32, MKV_VOID):
+            return False  # Stale once the cluster sizes change
+        if element_id == MKV_ENCRYPTED_BLOCK:
+            raise ContainerParseError("encrypted blocks")
+        if element_id == MKV_BLOCK_GROUP:
+            block = ebml_fields(view, start, end).get(MKV_BLOCK)
+            if not block:
+                raise ContainerParseError("block group without a block")
+            start, end = block
+        elif element_id != MKV_SIMPLE_BLOCK:
+            return True  # Timestamp, SilentTracks
+        track_number, _ = ebml_vint(view, start, end, False)
+        return track_number not in self.removed_numbers
+    
+    def rewrite_tracks(self, payload: bytes) -> bytes:
+        kept, position = [], 0
+        for element_id, start, end in ebml_children(payload, 0, len(payload)):
+            if element_id != MKV_TRACK_ENTRY:
+                continue  # CRC-32 and Void
+            if position in self.removed_entries:
+                fields = ebml_fields(payload, start, end)
+                track_type = ebml_uint(payload, *fields[MKV_TRACK_TYPE]) if MKV_TRACK_TYPE in fields else 0
+                if track_type not in MKV_REMOVABLE_TRACK_TYPES or MKV_TRACK_NUMBER not in fields:
+                    raise ContainerParseError(f"track {position} is not an audio or subtitle track")
+                self.removed_numbers.add(ebml_uint(payload, *fields[MKV_TRACK_NUMBER]))
+                if MKV_TRACK_UID in fields:
+                    self.removed_uids.add(ebml_uint(payload, *fields[MKV_TRACK_UID]))
+            else:
+                kept.append(ebml_element(MKV_TRACK_ENTRY, payload[start:end]))
+            position += 1
+        if any(entry >= position for entry in self.removed_entries):
+            raise ContainerParseError("removed track not found")
+        return b''.join(kept)
+    
+    def rewrite_tags(self, payload: bytes) -> bytes:
+        """Drop the tags that only describe removed tracks"""
+        kept = []
+        for element_id, start, end in ebml_children(payload, 0, len(payload)):
+            if element_id != MKV_TAG:
+                continue
+            targets = ebml_fields(payload, start, end).get(MKV_TARGETS)
+            if targets:
+                uids = {ebml_uint(payload, uid_start, uid_end) for uid_id, uid_start, uid_end in ebml_children(payload, *targets) if uid_id == MKV_TAG_TRACK_UID}
+                if uids and uids <= self.removed_uids:
+                    continue
+            kept.append(ebml_element(MKV_TAG, payload[start:end]))
+        return b''.join(kept)
+    
+    def rewrite_cues(self, payload: bytes) -> bytes:
+        """Drop the removed tracks' cues and move the rest to the new cluster positions"""
+        points = []
+        for element_id, start, end in ebml_children(payload, 0, len(payload)):
+            if element_id != MKV_CUE_POINT:
+                continue
+            children, has_positions = [], False
+            for child_id, child_start, child_end in ebml_children(payload, start, end):
+                if child_id != MKV_CUE_TRACK_POSITIONS:
+                    children.append(ebml_element(child_id, payload[child_start:child_end]))
+                    continue
+                fields = ebml_fields(payload, child_start, child_end)
+                if MKV_CUE_TRACK not in fields or MKV_CUE_CLUSTER_POSITION not in fields:
+                    raise ContainerParseError("incomplete cue")
+                track_number = ebml_uint(payload, *fields[MKV_CUE_TRACK])
+                if track_number in self.removed_numbers:
+                    continue
+                old_cluster = ebml_uint(payload, *fields[MKV_CUE_CLUSTER_POSITION])
+                if old_cluster not in self.clusters:
+                    raise ContainerParseError("cue for a cluster that was not copied")
+                new_cluster, first, last = self.clusters[old_cluster]
+                # Block numbers, codec states and references go stale and are optional
+                positions = ebml_uint_element(MKV_CUE_TRACK, track_number) + ebml_uint_element(MKV_CUE_CLUSTER_POSITION, new_cluster)
+                if MKV_CUE_RELATIVE_POSITION in fields:
+                    relative = ebml_uint(payload, *fields[MKV_CUE_RELATIVE_POSITION])
+                    drop = bisect.bisect_left(self.drop_offsets, relative, first, last)
+                    relative -= self.drop_totals[drop - 1] if drop > first else 0
+                    positions += ebml_uint_element(MKV_CUE_RELATIVE_POSITION, relative)
+                if MKV_CUE_DURATION in fields:
+                    positions += ebml_element(MKV_CUE_DURATION, payload[slice(*fields[MKV_CUE_DURATION])])
+                children.append(ebml_element(MKV_CUE_TRACK_POSITIONS, positions))
+                has_positions = True
+            if has_positions:
+                points.append(ebml_element(MKV_CUE_POINT, b''.join(children)))
+        return b''.join(points)
+
+def native_remux_eligible(plan: Dict) -> bool:
+    """Whether the plan is a plain Matroska track removal the rewriter can do.
+    
+    Only for plans built from the native probe: ffprobe may skip tracks it does
+    not support, and its indices would then point at the wrong TrackEntry.
+    """
+    return (
+        NATIVE_REMUX_ENABLED and plan['write_video'] and bool(plan['removed']) and plan['native_probe']
+        and plan['source_container'] == 'matroska' and plan['container'] == 'matroska'
+        and not plan['extractions'] and not plan['codec_overrides'] and not plan['dropped']
+    )
+
+# ===== FFMPEG CAPABILITIES =====
+FFMPEG_VERSION_RE = re.compile(r'^ffmpeg version (\S+)')
+FFMPEG_MUXER_RE = re.compile(r'^\s*D?E\s+(\S+)\s', re.MULTILINE)
+FFMPEG_SUBTITLE_ENCODER_RE = re.compile(r'^\s*S[A-Z.]{5}\s+([\w-]+)\s', re.MULTILINE)
+
+def binary_signature(path: str) -> List:
+    """Cheap change check for a binary: path, size and mtime"""
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def hash_binaries(*paths: str) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def detect_ffmpeg_capabilities(ffmpeg_path: str, ffprobe_path: str) -> Dict:
+    """Ask the ffmpeg build what it supports (several subprocess calls, so cached)"""
+    def output(*args: str) -> str:
+        result = subprocess.run(args, capture_output=True, text=True, timeout=30, check=True)
+        return result.stdout + result.stderr
+    
+    version = FFMPEG_VERSION_RE.match(output(ffmpeg_path, '-hide_banner', '-version'))
+    muxers = set()
+    for names in FFMPEG_MUXER_RE.findall(output(ffmpeg_path, '-hide_banner', '-muxers')):
+        muxers.update(names.split(','))
+    
+    return {
+        'version': version.group(1) if version else 'unknown',
+        'muxers': sorted(muxers),
+        'subtitle_encoders': sorted(FFMPEG_SUBTITLE_ENCODER_RE.findall(output(ffmpeg_path, '-hide_banner', '-encoders'))),
+        'progress': '-progress' in output(ffmpeg_path, '-hide_banner', '-h', 'long'),
+        'show_entries': '-show_entries' in output(ffprobe_path, '-hide_banner', '-h')
+    }
+
+def load_ffmpeg_capabilities() -> bool:
+    """Fill ffmpeg_capabilities from the cache, or detect them for a new ffmpeg build.
+    
+    The cache is keyed by the SHA-256 of the ffmpeg and ffprobe binaries; an
+    unchanged size and mtime skips even the hashing. False if ffmpeg is missing.
+    """
+    ffmpeg_path, ffprobe_path = shutil.which('ffmpeg'), shutil.which('ffprobe')
+    if not ffmpeg_path or not ffprobe_path:
+        return False
+    ffmpeg_path, ffprobe_path = os.path.realpath(ffmpeg_path), os.path.realpath(ffprobe_path)
+    signature = [binary_signature(ffmpeg_path), binary_signature(ffprobe_path)]
+    
+    cached = {}
+    try:
+        with open(FFMPEG_CAPABILITIES_CACHE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    if cached.get('signature') == signature:
+        ffmpeg_capabilities.update(cached)
+        return True
+    
+    key = hash_binaries(ffmpeg_path, ffprobe_path)
+    if cached.get('key') == key:
+        capabilities = cached  # Same build, only touched (e.g. reinstalled)
+    else:
+        try:
+            capabilities = detect_ffmpeg_capabilities(ffmpeg_path, ffprobe_path)
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.error(f"Error detecting ffmpeg capabilities: {e}")
+            return False
+        capabilities['key'] = key
+        logger.info(f"Detected capabilities of ffmpeg {capabilities['version']}")
+    
+    capabilities['signature'] = signature
+    ffmpeg_capabilities.update(capabilities)
+    try:
+        temp_path = f"{FFMPEG_CAPABILITIES_CACHE}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(capabilities, f, indent=1)
+        os.replace(temp_path, FFMPEG_CAPABILITIES_CACHE)
+    except OSError as e:
+        logger.warning(f"Could not cache ffmpeg capabilities: {e}")
+    return True
+
+def muxer_available(muxer: str) -> bool:
+    return 'muxers' not in ffmpeg_capabilities or muxer in ffmpeg_capabilities['muxers']
+
+def subtitle_encoder_available(encoder: str) -> bool:
+    if encoder == 'copy' or 'subtitle_encoders' not in ffmpeg_capabilities:
+        return True
+    return encoder in ffmpeg_capabilities['subtitle_encoders']
+
+# ===== FFMPEG ISOLATION =====
+_cgroup_available: Optional[bool] = None
+_isolation_prefix: Optional[List[str]] = None
+
+def isolation_prefix() -> List[str]:
+    """taskset/ionice/nice wrapper that applies the priority limits at exec (built once).
+    
+    No Python runs in the forked child, which is not safe with the bot's threads.
+    Tools that are not installed are skipped - isolation must never stop a job from running.
+    """
+    global _isolation_prefix
+    if _isolation_prefix is None:
+        prefix = []
+        if FFMPEG_CPU_AFFINITY and shutil.which('taskset'):
+            prefix += ['taskset', '-c', ','.join(str(cpu) for cpu in sorted(FFMPEG_CPU_AFFINITY))]
+        if FFMPEG_IONICE_CLASS and shutil.which('ionice'):
+            # -t: run the command even if the class cannot be set
+            if FFMPEG_IONICE_CLASS == "idle":
+                prefix += ['ionice', '-t', '-c', '3']
+            else:
+                prefix += ['ionice', '-t', '-c', '2', '-n', str(FFMPEG_IONICE_LEVEL)]
+        if FFMPEG_NICE and shutil.which('nice'):
+            prefix += ['nice', '-n', str(FFMPEG_NICE)]
+        _isolation_prefix = prefix
+    return _isolation_prefix
+
+def cgroup_available() -> bool:
+    """Whether per-job cgroups can be created under FFMPEG_CGROUP_ROOT (checked once)"""
+    global _cgroup_available
+    if _cgroup_available is None:
+        _cgroup_available = os.path.isdir(FFMPEG_CGROUP_ROOT) and os.access(FFMPEG_CGROUP_ROOT, os.W_OK)
+        if _cgroup_available:
+            try:
+                # Let job cgroups use the cpu/io/memory controllers
+                with open(os.path.join(FFMPEG_CGROUP_ROOT, 'cgroup.subtree_control'), 'w') as f:
+                    f.write("+cpu +io +memory")
+            except OSError as e:
+                logger.warning(f"Could not enable cgroup controllers: {e}")
+    return _cgroup_available
+
+def create_job_cgroup() -> Optional[str]:
+    """Create a cgroup v2 group with the per-job limits (None when unavailable)"""
+    if not cgroup_available():
+        return None
+    
+    cgroup_dir = os.path.join(FFMPEG_CGROUP_ROOT, f"job-{uuid.uuid4().hex[:8]}")
+    try:
+        os.mkdir(cgroup_dir)
+    except OSError as e:
+        logger.warning(f"Could not create cgroup {cgroup_dir}: {e}")
+        return None
+    
+    limits = {
+        'cpu.max': FFMPEG_CGROUP_CPU_MAX,
+        'io.weight': f"default {FFMPEG_CGROUP_IO_WEIGHT}",
+        'memory.max': FFMPEG_CGROUP_MEMORY_MAX
+    }
+    for name, value in limits.items():
+        try:
+            with open(os.path.join(cgroup_dir, name), 'w') as f:
+                f.write(str(value))
+        except OSError:
+            pass  # Controller not enabled for this subtree
+    return cgroup_dir
+
+def remove_job_cgroup(cgroup_dir: Optional[str]):
+    if not cgroup_dir:
+        return
+    try:
+        os.rmdir(cgroup_dir)
+    except OSError as e:
+        logger.warning(f"Could not remove cgroup {cgroup_dir}: {e}")
+
+def lower_thread_priority():
+    """Give the calling thread the ffmpeg nice/ionice/CPU limits (per thread on Linux).
+    
+    For work done inside the bot process; cgroup limits do not apply to threads.
+    Failures are ignored - isolation must never stop a job from running.
+    """
+    tid = threading.get_native_id()
+    try:
+        if FFMPEG_NICE:
+            niceness = os.getpriority(os.PRIO_PROCESS, tid)
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, niceness + FFMPEG_NICE))
+        if FFMPEG_CPU_AFFINITY:
+            os.sched_setaffinity(tid, FFMPEG_CPU_AFFINITY)
+        if FFMPEG_IONICE_CLASS == "idle":
+            psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_IDLE)
+        elif FFMPEG_IONICE_CLASS == "best-effort":
+            psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_BE, FFMPEG_IONICE_LEVEL)
+    except (OSError, AttributeError, ValueError, psutil.Error):
+        pass
+
+def join_job_cgroup(cgroup_dir: Optional[str], pid: int):
+    """Move a started process into the job cgroup (from the parent, right after spawn)"""
+    if not cgroup_dir:
+        return
+    try:
+        with open(os.path.join(cgroup_dir, 'cgroup.procs'), 'w') as f:
+            f.write(str(pid))
+    except OSError as e:
+        logger.warning(f"Could not move process {pid} into {cgroup_dir}: {e}")
+
+async def run_isolated(cmd: List[str], timeout: float, capture_stdout: bool = False) -> Tuple[int, str, str]:
+    """Run a command with the ffmpeg resource controls without blocking the event loop.
+    
+    Returns (returncode, stdout, stderr) - stdout is '' unless captured.
+    Raises asyncio.TimeoutError after timeout.
+    """
+    cgroup_dir = create_job_cgroup()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *isolation_prefix(), *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        join_job_cgroup(cgroup_dir, process.pid)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        return (
+            process.returncode,
+            stdout.decode('utf-8', errors='replace') if stdout else '',
+            stderr.decode('utf-8', errors='replace')
+        )
+    finally:
+        remove_job_cgroup(cgroup_dir)
+
+# ===== REMUX PLANNER =====
+# Codecs the MP4/MOV muxer accepts for stream copy
+MP4_CODECS = {
+    'video': {'h264', 'hevc', 'av1', 'vp9', 'mpeg4', 'mpeg2video', 'mjpeg', 'png'},
+    'audio': {'aac', 'mp3', 'ac3', 'eac3', 'opus', 'flac', 'alac', 'mp2', 'dts'},
+    'subtitle': {'mov_text'}
+}
+# Codecs Matroska cannot copy, with the cheap text conversion used instead
+MATROSKA_CONVERSIONS = {'mov_text': 'srt'}
+CONTAINER_EXTENSIONS = {'matroska': '.mkv', 'mp4': '.mp4', 'mov': '.mov'}
+# Standalone files for extracted tracks: codec -> (muxer, extension, encoder)
+EXTRACT_FORMATS = {
+    'subrip': ('srt', '.srt', 'copy'),
+    'mov_text': ('srt', '.srt', 'srt'),
+    'ass': ('ass', '.ass', 'copy'),
+    'ssa': ('ass', '.ass', 'copy'),
+    'webvtt': ('webvtt', '.vtt', 'copy'),
+    'hdmv_pgs_subtitle': ('sup', '.sup', 'copy'),
+    'aac': ('ipod', '.m4a', 'copy'),
+    'alac': ('ipod', '.m4a', 'copy'),
+    'ac3': ('ac3', '.ac3', 'copy'),
+    'eac3': ('eac3', '.eac3', 'copy'),
+    'dts': ('dts', '.dts', 'copy'),
+    'truehd': ('truehd', '.thd', 'copy'),
+    'flac': ('flac', '.flac', 'copy'),
+    'mp3': ('mp3', '.mp3', 'copy'),
+    'opus': ('opus', '.opus', 'copy'),
+    'vorbis': ('ogg', '.ogg', 'copy')
+}
+# Anything else is copied into a Matroska audio/subtitle file
+EXTRACT_FALLBACK = {
+    'audio': ('matroska', '.mka', 'copy'),
+    'subtitle': ('matroska', '.mks', 'copy')
+}
+
+def detect_container(video_info: Dict) -> Optional[str]:
+    """Input container as 'matroska', 'mp4' or 'mov' (None if something else)"""
+    fmt = video_info.get('format', {})
+    format_name = fmt.get('format_name', '')
+    
+    if 'matroska' in format_name:
+        return 'matroska'  # WebM is written back as Matroska, which holds any codec
+    if 'mp4' in format_name or 'mov' in format_name:
+        major_brand = fmt.get('tags', {}).get('major_brand', '').strip()
+        return 'mov' if major_brand == 'qt' else 'mp4'
+    return None
+
+def stream_fits_container(stream: Dict, container: str) -> bool:
+    """Whether a stream can be stream-copied into the container"""
+    codec_type = stream.get('codec_type')
+    codec_name = stream.get('codec_name', '')
+    
+    if container == 'matroska':
+        return codec_type in ('video', 'audio', 'subtitle', 'attachment') and codec_name not in MATROSKA_CONVERSIONS
+    
+    if container == 'mov' and codec_type == 'audio' and codec_name.startswith('pcm_'):
+        return True
+    return codec_name in MP4_CODECS.get(codec_type, set())
+
+def plan_extraction(stream: Dict) -> Dict:
+    """Output format for a track extracted to its own file"""
+    codec_name = stream.get('codec_name', '')
+    muxer, extension, encoder = EXTRACT_FORMATS.get(codec_name, EXTRACT_FALLBACK[stream['codec_type']])
+    if not muxer_available(muxer) or (stream['codec_type'] == 'subtitle' and not subtitle_encoder_available(encoder)):
+        muxer, extension, encoder = EXTRACT_FALLBACK[stream['codec_type']]
+    language = stream.get('tags', {}).get('language', 'und')
+    return {
+        'index': stream['index'],
+        'codec_type': stream['codec_type'],
+        'format': muxer,
+        'extension': extension,
+        'encoder': encoder,
+        'filename': f"track{stream['index']}_{language}{extension}",
+        'path': None  # Set by the job before running
+    }
+
+def plan_remux(video_info: Dict, audio_tracks_to_remove: Set[int], subtitle_tracks_to_remove: Set[int], tracks_to_extract: Set[int] = frozenset(), force_container: Optional[str] = None) -> Dict:
+    """Work out the explicit stream maps and output container for a removal job.
+    
+    Track sets hold global ffprobe stream indices (as shown in the selection
+    menu). The source container is kept when every remaining stream fits it,
+    otherwise Matroska is used (or only force_container, if given). Extracted
+    tracks become extra outputs of the same ffmpeg run; the cleaned video is
+    skipped when nothing is removed. plan['error'] is set when the job cannot work.
+    """
+    plan = {
+        'write_video': True,
+        'extractions': [],  # One standalone output per extracted track
+        'container': None,
+        'extension': None,
+        'maps': [],  # Global input stream indices, in output order
+        'codec_overrides': {},  # Output stream position -> codec (instead of copy)
+        'dropped': [],  # Data streams the target container cannot hold
+        'removed': [],  # Removed stream indices
+        'source_container': None,
+        'native_probe': video_info.get('parser') == 'native',  # Indices are TrackEntry positions
+        'error': None
+    }
+    
+    streams = video_info.get('streams', [])
+    if not streams:
+        plan['error'] = "Could not read the video's tracks."
+        return plan
+    
+    streams_by_index = {stream['index']: stream for stream in streams}
+    requested = [(index, 'audio') for index in audio_tracks_to_remove]
+    requested += [(index, 'subtitle') for index in subtitle_tracks_to_remove]
+    for index, codec_type in requested:
+        if streams_by_index.get(index, {}).get('codec_type') != codec_type:
+            plan['error'] = f"Track {index} ({codec_type}) was not found."
+            return plan
+    
+    for index in sorted(tracks_to_extract):
+        stream = streams_by_index.get(index, {})
+        if stream.get('codec_type') not in ('audio', 'subtitle'):
+            plan['error'] = f"Track {index} cannot be extracted."
+            return plan
+        plan['extractions'].append(plan_extraction(stream))
+    
+    removed = set(audio_tracks_to_remove) | set(subtitle_tracks_to_remove)
+    if not removed and plan['extractions']:
+        plan['write_video'] = False  # Output would be identical to the input
+        return plan
+    
+    kept_streams = [stream for stream in streams if stream['index'] not in removed]
+    if not any(stream.get('codec_type') in ('video', 'audio') for stream in kept_streams):
+        plan['error'] = "No video or audio track would be left."
+        return plan
+    
+    source_container = detect_container(video_info)
+    plan['removed'] = sorted(removed)
+    plan['source_container'] = source_container
+    candidates = [source_container] if source_container else []
+    if 'matroska' not in candidates:
+        candidates.append('matroska')
+    if force_container:
+        candidates = [force_container]
+    candidates = [container for container in candidates if muxer_available(container)]
+    
+    for container in candidates:
+        maps, codec_overrides, dropped = [], {}, []
+        
+        for stream in kept_streams:
+            codec_name = stream.get('codec_name', '')
+            if stream_fits_container(stream, container):
+                maps.append(stream['index'])
+            elif (container == 'matroska' and codec_name in MATROSKA_CONVERSIONS
+                    and subtitle_encoder_available(MATROSKA_CONVERSIONS[codec_name])):
+                codec_overrides[len(maps)] = MATROSKA_CONVERSIONS[codec_name]
+                maps.append(stream['index'])
+            elif stream.get('codec_type') in ('data', 'attachment'):
+                dropped.append(stream['index'])
+            else:
+                break  # A real track does not fit, try the next container
+        else:
+            plan.update({
+                'container': container,
+                'extension': CONTAINER_EXTENSIONS[container],
+                'maps': maps,
+                'codec_overrides': codec_overrides,
+                'dropped': dropped
+            })
+            return plan
+    
+    plan['error'] = "No supported container for the remaining tracks."
+    return plan
+
+def build_remux_command(input_path: str, output_path: Optional[str], plan: Dict) -> List[str]:
+    """ffmpeg command for a remux plan - explicit positive maps, stream copy.
+    
+    The cleaned video and every extracted track are outputs of a single
+    command, so the input is read only once.
+    """
+    cmd = [
+        'ffmpeg', '-hide_banner', '-nostdin',
+        '-i', input_path
+    ]
+    
+    if plan['write_video']:
+        for index in plan['maps']:
+            cmd.extend(['-map', f'0:{index}'])
+        
+        cmd.extend(['-c', 'copy'])  # Stream copy for maximum speed
+        for position, codec in plan['codec_overrides'].items():
+            cmd.extend([f'-c:{position}', codec])
+        
+        cmd.extend([
+            '-map_metadata', '0',
+            '-map_chapters', '0',
+            '-f', plan['container'],
+            '-y',  # Overwrite output file
+            output_path
+        ])
+    
+    for extraction in plan['extractions']:
+        cmd.extend([
+            '-map', f"0:{extraction['index']}",
+            '-c', extraction['encoder'],
+            '-f', extraction['format'],
+            '-y',
+            extraction['path']
+        ])
+    return cmd
+
+# Extraction muxers that keep the source's packets one to one
+VERIFY_PACKET_MUXERS = {'matroska', 'ipod', 'ogg', 'opus'}
+
+async def verify_outputs(plan: Dict, output_path: Optional[str], source: Optional[Dict], timeout: float) -> Optional[str]:
+    """Check ffmpeg's outputs against the source and the plan without decoding.
+    
+    Compares stream count and types, kept languages, per-stream packet counts
+    and duration. Returns the first problem found, None if the outputs look
+    right or could not be checked in time.
+    """
+    source_streams = {stream['index']: stream for stream in (source or {}).get('streams', [])}
+    if not source_streams:
+        logger.warning("Source packet count unavailable, outputs not verified")
+        return None  # Nothing to compare against
+    
+    # (path, source index per output stream, positions whose packets may differ)
+    checks = []
+    if plan['write_video']:
+        checks.append((output_path, plan['maps'], set(plan['codec_overrides'])))
+    for extraction in plan['extractions']:
+        # Raw elementary files (.ac3, .srt, ...) are re-parsed into different packets
+        same_packets = extraction['encoder'] == 'copy' and extraction['format'] in VERIFY_PACKET_MUXERS
+        checks.append((extraction['path'], [extraction['index']], set() if same_packets else {0}))
+    
+    for path, maps, converted in checks:
+        is_video = path == output_path
+        name = os.path.basename(path)
+        output = await count_packets(path, timeout)
+        if output is None:
+            logger.warning(f"Packet count of {name} unavailable, outputs not verified")
+            return None
+        streams = output.get('streams', [])
+        if len(streams) != len(maps):
+            return f"{name} has {len(streams)} streams instead of {len(maps)}"
+        
+        for position, (stream, index) in enumerate(zip(streams, maps)):
+            expected = source_streams.get(index, {})
+            if stream.get('codec_type') != expected.get('codec_type'):
+                return f"{name} stream {position} is {stream.get('codec_type')}, expected {expected.get('codec_type')}"
+            
+            # Standalone track files mostly have no place for a language tag
+            language = expected.get('tags', {}).get('language')
+            if is_video and language and language != 'und' and stream.get('tags', {}).get('language') != language:
+                return f"{name} stream {position} lost its language ({language})"
+            
+            if position in converted:
+                continue
+            source_packets = int(expected.get('nb_read_packets') or 0)
+            output_packets = int(stream.get('nb_read_packets') or 0)
+            if source_packets and abs(output_packets - source_packets) > max(2, source_packets * 0.005):
+                return f"{name} stream {position} has {output_packets} packets instead of {source_packets}"
+        
+        if not is_video:
+            continue
+        # Only where the source reports per-stream durations (MP4, not Matroska)
+        expected_duration = max(float(source_streams[index].get('duration') or 0) for index in maps)
+        output_duration = float(output.get('format', {}).get('duration') or 0)
+        if expected_duration and output_duration < expected_duration - max(1.0, expected_duration * 0.01):
+            return f"{name} is {output_duration:.1f}s long instead of {expected_duration:.1f}s"
+    
+    return None
+
+async def remove_tracks(input_path: str, output_path: Optional[str], plan: Dict, trace_span: Optional[Dict] = None, timeout: float = PROCESS_TIMEOUT, allow_native: bool = True) -> bool:
+    """Run a remux plan - in-process for plain Matroska removals, otherwise ffmpeg isolated from the bot"""
+    if allow_native and native_remux_eligible(plan):
+        stripper = MatroskaTrackStripper(set(plan['removed']))
+        # A fresh thread, so its lowered priority ends with it
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='native-remux')
+        try:
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(executor, stripper.strip_file, input_path, output_path),
+                timeout
+            )
+            if trace_span is not None:
+                trace_span['engine'] = 'native'
+            return True
+        except asyncio.TimeoutError:
+            stripper.cancelled.set()
+            logger.error(f"Native remux timed out after {timeout:.0f}s")
+            if trace_span is not None:
+                trace_span['timed_out'] = True
+            return False
+        except asyncio.CancelledError:
+            stripper.cancelled.set()
+            raise
+        except Exception as e:
+            logger.info(f"Native remux not possible, using ffmpeg: {e}")
+            cleanup_files(output_path)
+        finally:
+            executor.shutdown(wait=False)
+    
+    if trace_span is not None:
+        trace_span['engine'] = 'ffmpeg'
+    try:
+        cmd = build_remux_command(input_path, output_path, plan)
+        
+        # Run ffmpeg with timeout
+        returncode, _, stderr = await run_isolated(cmd, timeout)
+        
+        # Record the final ffmpeg speed (e.g. "speed=12.3x") for the job trace
+        if trace_span is not None:
+            speeds = FFMPEG_SPEED_RE.findall(stderr)
+            if speeds:
+                trace_span['speed'] = float(speeds[-1])
+        
+        if returncode == 0:
+            return True
+        else:
+            logger.error(f"FFmpeg error: {stderr}")
+            return False
+            
+    except asyncio.TimeoutError:
+        logger.error(f"FFmpeg process timed out after {timeout:.0f}s")
+        if trace_span is not None:
+            trace_span['timed_out'] = True
+        return False
+    except Exception as e:
+        logger.error(f"Error in remove_tracks: {e}")
+        return False
+
+# ===== FILE TRANSFERS =====
+class TransferBot:
+    """A bot that moves job files, with its own load, health and FloodWait tracking"""
+
+    def __init__(self, bot: Bot, name: str, is_primary: bool = False):
+        self.bot = bot
+        self.name = name
+        self.is_primary = is_primary
+        self.active = 0
+        self.transfers = 0
+        self.failures = 0  # Consecutive
+        self.cooldown_until = 0.0
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def record_success(self):
+        self.transfers += 1
+        self.failures = 0
+
+    def record_failure(self, error: Exception):
+        if isinstance(error, RetryAfter):
+            seconds = retry_after_seconds(error)
+            self.cooldown_until = time.monotonic() + seconds
+            logger.warning(f"Transfer bot {self.name} flood limited for {seconds}s")
+        elif not self.is_primary:
+            # The primary bot also fails on bad files, only back off helpers
+            self.failures += 1
+            self.cooldown_until = time.monotonic() + HELPER_FAILURE_COOLDOWN * 2 ** min(self.failures - 1, 5)
+
+class TransferPool:
+    """Spreads job file transfers over the primary bot and helper bots by load.
+
+    file_ids belong to one bot, so helpers exchange files with the primary
+    bot through TRANSFER_CHANNEL_ID: the primary copies the user's video
+    there and the helper forwards it to get its own file_id; helper uploads
+    go to the channel and the primary copies them to the user.
+    """
+
+    def __init__(self, primary: Bot, helpers: List[Bot]):
+        self.primary = TransferBot(primary, 'primary', is_primary=True)
+        self.members = [self.primary] + [
+            TransferBot(helper, f"helper{position}") for position, helper in enumerate(helpers, 1)
+        ]
+
+    def pick(self) -> TransferBot:
+        """Least loaded healthy bot, the primary one on ties"""
+        candidates = [member for member in self.members if member.healthy()] or [self.primary]
+        return min(candidates, key=lambda member: (member.active, not member.is_primary))
+
+    def summary(self) -> str:
+        """One line per transfer bot for /status"""
+        lines = []
+        for member in self.members:
+            line = f"🚚 {member.name}: {member.active} active | {member.transfers} done"
+            if not member.healthy():
+                line += f" | cooling down {format_eta(member.cooldown_until - time.monotonic())}"
+            lines.append(line)
+        return "\n".join(lines)
+
+async def start_transfer_pool(primary: Bot):
+    """Start the helper bots, if any are configured"""
+    global transfer_pool
+    if not HELPER_BOT_TOKENS:
+        return
+    if LOCAL_MODE:
+        logger.info("Helper bots are not used with a local Bot API server")
+        return
+    if not TRANSFER_CHANNEL_ID:
+        logger.warning("HELPER_BOT_TOKENS set without TRANSFER_CHANNEL_ID, helpers disabled")
+        return
+    
+    helpers = []
+    for token in HELPER_BOT_TOKENS:
+        helper = ExtBot(token, rate_limiter=TelegramCallScheduler())
+        try:
+            await helper.initialize()
+            helpers.append(helper)
+        except Exception as e:
+            logger.error(f"Helper bot failed to start: {e}")
+    
+    transfer_pool = TransferPool(primary, helpers)
+    logger.info(f"Transfer pool started with {len(helpers)} helper bot(s)")
+
+async def stop_transfer_pool():
+    for member in (transfer_pool.members[1:] if transfer_pool else []):
+        try:
+            await member.bot.shutdown()
+        except Exception as e:
+            logger.error(f"Error stopping {member.name}: {e}")
+
+async def run_transfer(transfer):
+    """Run `transfer(helper)` on the least loaded transfer bot (helper=None for
+    the primary bot), falling back to the primary bot if a helper fails"""
+    if transfer_pool is None:
+        return await transfer(None)
+    
+    member = transfer_pool.pick()
+    if not member.is_primary:
+        try:
+            return await attempt_transfer(member, transfer)
+        except Exception as e:
+            logger.warning(f"Transfer via {member.name} failed, using the primary bot: {e}")
+    return await attempt_transfer(transfer_pool.primary, transfer)
+
+async def attempt_transfer(member: TransferBot, transfer):
+    """One transfer attempt on one bot, with its load and health bookkeeping"""
+    member.active += 1
+    try:
+        result = await transfer(None if member.is_primary else member.bot)
+    except Exception as e:
+        member.record_failure(e)
+        raise
+    finally:
+        member.active -= 1
+    member.record_success()
+    return result
+
+async def discard_relay_messages(bot: Bot, message_ids: List[int]):
+    """Delete relayed files from the transfer channel"""
+    try:
+        await bot.delete_messages(chat_id=TRANSFER_CHANNEL_ID, message_ids=message_ids)
+    except Exception as e:
+        logger.error(f"Error deleting relay messages {message_ids}: {e}")
+
+async def relay_to_chat(bot: Bot, chat_id: int, message_ids: List[int]):
+    """Copy helper uploads from the transfer channel to the user, captions and albums included"""
+    try:
+        await bot.copy_messages(chat_id=chat_id, from_chat_id=TRANSFER_CHANNEL_ID, message_ids=message_ids)
+    finally:
+        await discard_relay_messages(bot, message_ids)
+
+SCRATCH_PREFIX = "trackkiller_"
+SCRATCH_SPACE_FACTOR = 2.5  # Input + remuxed output + extracted tracks, relative to the input
+
+def allocate_scratch(file_size: int, space_factor: float = SCRATCH_SPACE_FACTOR) -> str:
+    """Create a job scratch directory: on RAM while the budget allows, else on disk"""
+    prefix = f"{SCRATCH_PREFIX}{os.getpid()}_"
+    expected_bytes = int(file_size * space_factor)
+    
+    if SCRATCH_RAM_DIR and 0 < file_size <= SCRATCH_RAM_MAX_FILE:
+        reserved = sum(scratch_dirs.values())
+        try:
+            if (reserved + expected_bytes <= SCRATCH_RAM_BUDGET
+                    and psutil.disk_usage(SCRATCH_RAM_DIR).free >= expected_bytes):
+                path = tempfile.mkdtemp(prefix=prefix, dir=SCRATCH_RAM_DIR)
+                scratch_dirs[path] = expected_bytes
+                return path
+        except OSError as e:
+            logger.warning(f"RAM scratch unavailable, using disk: {e}")
+    
+    path = tempfile.mkdtemp(prefix=prefix, dir=SCRATCH_DISK_DIR or None)
+    scratch_dirs[path] = 0
+    return path
+
+def scratch_tier(path: str) -> str:
+    return 'ram' if scratch_dirs.get(path) else 'disk'
+
+def release_scratch(path: str):
+    """Delete a scratch directory with everything in it and free its RAM reservation"""
+    scratch_dirs.pop(path, None)
+    shutil.rmtree(path, ignore_errors=True)
+    logger.info(f"Cleaned up: {path}")
+
+def cleanup_stale_scratch():
+    """Remove scratch directories left behind by processes that no longer run"""
+    for root in filter(None, (SCRATCH_RAM_DIR, SCRATCH_DISK_DIR or tempfile.gettempdir())):
+        try:
+            entries = os.listdir(root)
+        except OSError:
+            continue
+        for entry in entries:
+            if not entry.startswith(SCRATCH_PREFIX):
+                continue
+            pid = entry[len(SCRATCH_PREFIX):].split('_', 1)[0]
+            if pid.isdigit() and not psutil.pid_exists(int(pid)):
+                shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+                logger.info(f"Removed stale scratch directory {entry}")
+
+def cleanup_files(*file_paths):
+    """Clean up temporary files and scratch directories - ENHANCED"""
+    for file_path in file_paths:
+        try:
+            if file_path in scratch_dirs:
+                release_scratch(file_path)
+            elif file_path and os.path.exists(file_path):
+                os.remove(file_path)
+                logger.info(f"Cleaned up: {file_path}")
+        except Exception as e:
+            logger.error(f"Error cleaning up file {file_path}: {e}")
+
+def make_output_path(input_path: str, extension: str = '.mp4', directory: Optional[str] = None) -> str:
+    """Temp path for the processed file (never next to a Bot API server file)"""
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(directory or tempfile.gettempdir(), f"{name}_{uuid.uuid4().hex[:8]}_processed{extension}")
+
+async def download_video(bot: Bot, file_id: str, trace: JobTrace, downloaded_files: List[str]) -> str:
+    """Download a video to a temp file and register it in downloaded_files for cleanup.
+    
+    Only a complete download is registered: a failed one is deleted right away.
+    With a local Bot API server the file is already on disk: its path is
+    returned as-is (read in place, never cleaned up by us).
+    """
+    with trace.span('get_file'):
+        video_file = await bot.get_file(file_id)
+    
+    if LOCAL_MODE and video_file.file_path and os.path.isabs(video_file.file_path):
+        if os.path.exists(video_file.file_path):
+            with trace.span('local_file', size=os.path.getsize(video_file.file_path)):
+                return video_file.file_path
+        logger.warning(f"Local Bot API file not accessible, copying instead: {video_file.file_path}")
+    
+    # The job's outputs are written next to the input, so reserve room for them too
+    scratch_dir = allocate_scratch(video_file.file_size or 0)
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4', dir=scratch_dir) as input_file:
+            input_path = input_file.name
+        with trace.span('download_to_drive', bytes=video_file.file_size or 0, tier=scratch_tier(scratch_dir)) as span:
+            await video_file.download_to_drive(input_path)
+            span['bytes'] = os.path.getsize(input_path)
+    except BaseException:
+        cleanup_files(scratch_dir)  # Takes the partial file with it
+        raise
+    
+    downloaded_files.extend([input_path, scratch_dir])
+    return input_path
+
+async def download_job_video(bot: Bot, job: Dict, trace: JobTrace, downloaded_files: List[str]) -> str:
+    """Download a job's video with the least loaded transfer bot"""
+    async def download(helper: Optional[Bot]) -> str:
+        if helper is None:
+            return await download_video(bot, job['file_id'], trace, downloaded_files)
+        
+        relay_ids = []
+        try:
+            with trace.span('relay'):
+                copied = await bot.copy_message(
+                    chat_id=TRANSFER_CHANNEL_ID, from_chat_id=job['chat_id'], message_id=job['video_message_id']
+                )
+                relay_ids.append(copied.message_id)
+                forwarded = await helper.forward_message(
+                    chat_id=TRANSFER_CHANNEL_ID, from_chat_id=TRANSFER_CHANNEL_ID, message_id=copied.message_id
+                )
+                relay_ids.append(forwarded.message_id)
+            media = forwarded.video or forwarded.document
+            return await download_video(helper, media.file_id, trace, downloaded_files)
+        finally:
+            if relay_ids:
+                await discard_relay_messages(bot, relay_ids)
+    
+    if not job.get('video_message_id'):
+        return await download(None)
+    return await run_transfer(download)
+
+def stage_local_upload(path: str, filename: str) -> str:
+    """Move a file to its user-facing name for the local server, which ignores filename=.
+    
+    It goes into its own directory inside the job's scratch dir (cleaned up with it).
+    """
+    directory = tempfile.mkdtemp(prefix='upload_', dir=os.path.dirname(path))
+    staged_path = os.path.join(directory, filename.replace(os.sep, '_'))
+    os.rename(path, staged_path)
+    return staged_path
+
+async def send_processed_video(bot: Bot, chat_id: int, output_path: str, caption: str, trace: JobTrace):
+    """Upload the processed video to the chat"""
+    extension = os.path.splitext(output_path)[1] or '.mp4'
+    filename = f"trackkiller_{datetime.now().strftime('%H%M%S')}{extension}"
+    
+    if LOCAL_MODE:
+        # The local server reads the file itself (file:// URI), no HTTP upload
+        output_path = stage_local_upload(output_path, filename)
+        with trace.span('send_document', size=os.path.getsize(output_path), local=True):
+            await bot.send_document(
+                chat_id=chat_id,
+                document=Path(output_path),
+                filename=filename,
+                caption=caption
+            )
+        return
+    
+    async def upload(helper: Optional[Bot]):
+        with trace.span('send_document', bytes=os.path.getsize(output_path)):
+            with open(output_path, 'rb') as video_file:
+                message = await (helper or bot).send_document(
+                    chat_id=TRANSFER_CHANNEL_ID if helper else chat_id,
+                    document=InputFile(video_file, filename=filename),
+                    caption=caption
+                )
+        if helper:
+            await relay_to_chat(bot, chat_id, [message.message_id])
+    
+    await run_transfer(upload)
+
+async def send_extracted_tracks(bot: Bot, chat_id: int, extractions: List[Dict], caption: Optional[str], trace: JobTrace):
+    """Upload extracted track files together, as document albums of up to 10"""
+    for start in range(0, len(extractions), 10):
+        batch = extractions[start:start + 10]
+        if LOCAL_MODE:
+            for extraction in batch:
+                extraction['path'] = stage_local_upload(extraction['path'], extraction['filename'])
+        batch_caption = caption if start == 0 else None
+        total_bytes = sum(os.path.getsize(extraction['path']) for extraction in batch)
+        
+        async def upload(helper: Optional[Bot]):
+            sender = helper or bot
+            target_chat_id = TRANSFER_CHANNEL_ID if helper else chat_id
+            with ExitStack() as stack, trace.span('send_media_group', bytes=0 if LOCAL_MODE else total_bytes):
+                documents = []
+                for extraction in batch:
+                    if LOCAL_MODE:
+                        documents.append(Path(extraction['path']).as_uri())
+                    else:
+                        documents.append(stack.enter_context(open(extraction['path'], 'rb')))
+                
+                if len(batch) == 1:
+                    messages = [await sender.send_document(
+                        chat_id=target_chat_id,
+                        document=documents[0],
+                        filename=batch[0]['filename'],
+                        caption=batch_caption
+                    )]
+                else:
+                    # Caption only on the first file of the album
+                    media = [
+                        InputMediaDocument(
+                            document,
+                            filename=extraction['filename'],
+                            caption=batch_caption if position == 0 else None
+                        )
+                        for position, (document, extraction) in enumerate(zip(documents, batch))
+                    ]
+                    messages = await sender.send_media_group(chat_id=target_chat_id, media=media)
+            if helper:
+                await relay_to_chat(bot, chat_id, [message.message_id for message in messages])
+        
+        await run_transfer(upload)
+
+# ===== JOB PIPELINE =====
+def video_meta(input_path: str, video_info: Dict) -> Dict:
+    """Features of a probed video, as used by the cost model"""
+    return {
+        'file_size': os.path.getsize(input_path),
+        'container': detect_container(video_info) or 'other',
+        'tracks': len(video_info.get('streams', []))
+    }
+
+def build_job(kind: str, user_id: int, processing_msg, user_session: Dict, remove_all_audio: bool = False, remove_all_subtitles: bool = False) -> Dict:
+    """Describe a processing job as a plain dict (serializable for the shared queue)"""
+    selected = kind == 'remove_selected'
+    job = {
+        'job_id': uuid.uuid4().hex[:8],
+        'kind': kind,
+        'user_id': user_id,
+        'chat_id': processing_msg.chat_id,
+        'status_message_id': processing_msg.message_id,
+        'file_id': user_session['video_file_id'],
+        'video_message_id': user_session.get('video_message_id'),
+        'remove_all_audio': remove_all_audio,
+        'remove_all_subtitles': remove_all_subtitles,
+        'audio_tracks': sorted(user_session['selected_audio_tracks']) if selected else [],
+        'subtitle_tracks': sorted(user_session['selected_subtitle_tracks']) if selected else [],
+        'extract_tracks': sorted(user_session.get('selected_extract_tracks', set())) if selected else [],
+        'file_size': user_session.get('file_size', 0),
+        'created_at': time.time()
+    }
+    
+    # Predicted duration orders the job in the scheduler and the shared queue
+    video_info = user_session.get('video_info')
+    downloaded = user_session.get('input_path') in user_session.get('downloaded_files', [])
+    job['predicted_seconds'] = cost_model.predict(
+        job_stages(job, downloaded),
+        job['file_size'],
+        detect_container(video_info) if video_info else None,
+        len(video_info.get('streams', [])) if video_info else 0
+    )['total']
+    return job
+
+async def run_job(bot: Bot, job: Dict, input_path: Optional[str] = None) -> JobTrace:
+    """Download, probe, remux and upload one job, reporting progress in its status message"""
+    trace = start_trace(job['kind'], job['user_id'], job['job_id'])
+    chat_id = job['chat_id']
+    message_id = job['status_message_id']
+    downloaded_files = []
+    output_path = None
+    extracted_paths = []
+    source_packets = None
+    
+    try:
+        # Download video unless the caller already has it on disk
+        if not input_path:
+            input_path = await download_job_video(bot, job, trace, downloaded_files)
+        
+        with trace.span('ffprobe'):
+            video_info = await asyncio.to_thread(get_video_info, input_path)
+        
+        trace.meta = video_meta(input_path, video_info)
+        
+        audio_tracks_to_remove = set(job['audio_tracks'])
+        subtitle_tracks_to_remove = set(job['subtitle_tracks'])
+        
+        if job['remove_all_audio']:
+            audio_tracks_to_remove = {track['index'] for track in get_audio_tracks(video_info)}
+        
+        if job['remove_all_subtitles']:
+            subtitle_tracks_to_remove = {track['index'] for track in get_subtitle_tracks(video_info)}
+        
+        # Validate the stream mapping before spending a full ffmpeg run on it
+        plan = plan_remux(
+            video_info, audio_tracks_to_remove, subtitle_tracks_to_remove, set(job.get('extract_tracks', []))
+        )
+        if plan['error']:
+            trace.finish('invalid_plan')
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"{EMOJI_ERROR} Cannot process: {plan['error']} (job {trace.trace_id})"
+            )
+            return trace
+        
+        # Outputs go next to our own download; Bot API server files get a scratch directory
+        scratch_dir = os.path.dirname(input_path)
+        if scratch_dir not in scratch_dirs:
+            scratch_dir = allocate_scratch(trace.meta['file_size'], SCRATCH_SPACE_FACTOR - 1)
+            downloaded_files.append(scratch_dir)
+        
+        remaining_stages = ['ffmpeg', 'verify'] + (['send_document'] if plan['write_video'] else [])
+        if plan['extractions']:
+            remaining_stages.append('send_media_group')
+        prediction = cost_model.predict(
+            remaining_stages, trace.meta['file_size'], trace.meta['container'], trace.meta['tracks']
+        )
+        
+        # Update processing message
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=(
+                f"{EMOJI_LOADING} Removing tracks...\n"
+                f"🎵 Audio: {len(audio_tracks_to_remove)} tracks\n"
+                f"📝 Subtitles: {len(subtitle_tracks_to_remove)} tracks\n"
+                f"📤 Extract: {len(plan['extractions'])} tracks\n"
+                f"⏱️ ETA: ~{format_eta(prediction['total'])}\n"
+                f"{get_system_status()}"
+            ),
+            rate_limit_args=PROGRESS_UPDATE
+        )
+        
+        remux_timeout = job_timeout(
+            prediction['ffmpeg'], cost_model.has_samples('ffmpeg', trace.meta['container'])
+        )
+        # Packet counts for the output check: MP4 sample tables have them, other
+        # sources are counted with a second read while ffmpeg runs
+        source_counts = video_info if has_packet_counts(video_info) else None
+        if source_counts is None:
+            source_packets = asyncio.create_task(probe_packets(input_path, remux_timeout))
+        verified = False
+        
+        for attempt in range(2):
+            if plan['write_video']:
+                output_path = make_output_path(input_path, plan['extension'], scratch_dir)
+            for extraction in plan['extractions']:
+                extraction['path'] = make_output_path(input_path, extraction['extension'], scratch_dir)
+                extracted_paths.append(extraction['path'])
+            
+            # Process video - one ffmpeg read for the cleaned video and all extracted tracks
+            with trace.span('ffmpeg', bytes=trace.meta['file_size']) as span:
+                success = await remove_tracks(
+                    input_path, output_path, plan, span, timeout=remux_timeout,
+                    allow_native=attempt == 0  # The retry goes through ffmpeg
+                )
+            
+            expected_outputs = ([output_path] if output_path else []) + extracted_paths
+            if not success or not all(os.path.exists(path) for path in expected_outputs):
+                break
+            
+            # Catch truncated or mis-mapped outputs before any bytes go to Telegram
+            with trace.span('verify') as span:
+                problem = await verify_outputs(
+                    plan, output_path, source_counts or await source_packets, remux_timeout
+                )
+                if problem:
+                    span['problem'] = problem
+            if not problem:
+                verified = True
+                break
+            
+            logger.warning(f"Job {trace.trace_id}: output check failed: {problem}")
+            cleanup_files(output_path, *extracted_paths)
+            output_path, extracted_paths = None, []
+            if attempt > 0:
+                break
+            
+            # Retry once, into Matroska (holds any codec and needs no conversions)
+            plan = plan_remux(
+                video_info, audio_tracks_to_remove, subtitle_tracks_to_remove,
+                set(job.get('extract_tracks', [])), force_container='matroska'
+            )
+            if plan['error']:
+                break
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"{EMOJI_LOADING} Output check failed, retrying...\n🔎 Job: {trace.trace_id}",
+                rate_limit_args=PROGRESS_UPDATE
+            )
+        
+        if verified:
+            summary = f"{EMOJI_SUCCESS} Processing completed!\n"
+            if output_path:
+                file_size = os.path.getsize(output_path) / (1024 * 1024)
+                summary += f"📁 Output: {file_size:.1f}MB ({plan['extension'][1:].upper()})\n"
+            summary += (
+                f"🎵 Audio removed: {len(audio_tracks_to_remove)}\n"
+                f"📝 Subtitles removed: {len(subtitle_tracks_to_remove)}\n"
+                f"📤 Tracks extracted: {len(extracted_paths)}\n"
+                f"🔎 Job: {trace.trace_id}"
+            )
+            
+            # Send processed video, then the extracted tracks right after it
+            if output_path:
+                await send_processed_video(bot, chat_id, output_path, summary, trace)
+            if plan['extractions']:
+                await send_extracted_tracks(
+                    bot, chat_id, plan['extractions'], None if output_path else summary, trace
+                )
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            trace.finish('ok')
+        else:
+            trace.finish('failed')
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"{EMOJI_ERROR} Processing failed. (job {trace.trace_id})"
+            )
+        
+    except Exception as e:
+        logger.error(f"Error in job {trace.trace_id}: {e}")
+        trace.finish('error')
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=f"{EMOJI_ERROR} Error: {str(e)} (job {trace.trace_id})"
+        )
+    
+    finally:
+        if source_packets is not None:
+            source_packets.cancel()  # Still running if ffmpeg failed early
+        trace.finish('cancelled')
+        cost_model.record(trace.to_dict())
+        # CLEANUP ALL FILES - Bot API server files are never in downloaded_files
+        cleanup_files(output_path, *extracted_paths, *downloaded_files)
+    
+    return trace
+
+async def submit_job(context: ContextTypes.DEFAULT_TYPE, job: Dict):
+    """Run a job in this process, or hand it to the shared queue for workers"""
+    user_session = user_sessions.get(job['user_id'], {})
+    user_session['processing'] = user_session.get('processing', 0) + 1  # Jobs of this session in flight
+    
+    if shared_queue is not None:
+        cancel_prefetch(user_session)
+        try:
+            try:
+                await asyncio.to_thread(shared_queue.enqueue, job)
+            except BaseException:
+                refund_user_bytes(job['user_id'], job['file_size'])
+                raise
+            await context.bot.edit_message_text(
+                chat_id=job['chat_id'],
+                message_id=job['status_message_id'],
+                text=f"📥 Queued for processing...\n🔎 Job: {job['job_id']}",
+                rate_limit_args=PROGRESS_UPDATE
+            )
+        finally:
+            # Workers download the file themselves
+            for file_path in user_session.get('downloaded_files', []):
+                cleanup_files(file_path)
+            user_session['downloaded_files'] = []
+            user_session['processing'] -= 1
+        return
+    
+    input_path = None
+    job_files = []
+    predicted = job.get('predicted_seconds', 0)
+    acquired = False
+    succeeded = False
+    try:
+        # Let a running prefetch finish, so this job can reuse its download
+        await wait_for_prefetch(user_session)
+        
+        if not scheduler.has_free_slot(job['user_id']):
+            ahead, wait = scheduler.queue_estimate(predicted)
+            await context.bot.edit_message_text(
+                chat_id=job['chat_id'],
+                message_id=job['status_message_id'],
+                text=(
+                    f"{EMOJI_LOADING} Queued behind {ahead} job(s)...\n"
+                    f"⏱️ ETA: ~{format_eta(wait + predicted)}\n"
+                    f"🔎 Job: {job['job_id']}"
+                ),
+                rate_limit_args=PROGRESS_UPDATE
+            )
+        
+        await scheduler.acquire(predicted, job['user_id'])
+        acquired = True
+        # Claimed only now: an earlier job of this session may have taken it while we queued
+        input_path = claim_prefetched_input(user_session, job_files)
+        await context.bot.edit_message_text(
+            chat_id=job['chat_id'],
+            message_id=job['status_message_id'],
+            text=(
+                f"{EMOJI_LOADING} Processing your video...\n"
+                f"⏱️ ETA: ~{format_eta(predicted)}\n"
+                f"{get_system_status()}"
+            ),
+            rate_limit_args=PROGRESS_UPDATE
+        )
+        trace = await run_job(context.bot, job, input_path)
+        succeeded = trace.status == 'ok'
+    finally:
+        if not succeeded:
+            refund_user_bytes(job['user_id'], job['file_size'])
+        cleanup_files(*job_files)
+        user_session['processing'] -= 1
+        if not user_session['processing']:
+            for file_path in user_session.get('downloaded_files', []):
+                cleanup_files(file_path)
+            user_session['downloaded_files'] = []
+        
+        if acquired:
+            scheduler.release(job['user_id'])
+
+def claim_prefetched_input(user_session: Dict, job_files: List[str]) -> Optional[str]:
+    """Move the session's probed download into one job's own cleanup list.
+    
+    Returns its path, or None if there is none (it was never downloaded
+    completely, was cleaned up, or another job took it) and the job must
+    download its own copy.
+    """
+    input_path = user_session.get('input_path')
+    downloaded_files = user_session.get('downloaded_files', [])
+    if input_path not in downloaded_files:
+        return None
+    
+    # The job writes its outputs next to the input, so the scratch dir goes with it
+    owned = [input_path]
+    scratch_dir = os.path.dirname(input_path)
+    if scratch_dir in downloaded_files:
+        owned.append(scratch_dir)
+    user_session['downloaded_files'] = [path for path in downloaded_files if path not in owned]
+    user_session.pop('input_path', None)
+    job_files.extend(owned)
+    return input_path
+
+# ===== PREFETCH =====
+def start_prefetch(bot: Bot, user_id: int, chat_id: int):
+    """Download and probe a new video in the background while the user picks an option"""
+    user_session = user_sessions[user_id]
+    if not PREFETCH_ENABLED or user_session['file_size'] > PREFETCH_MAX_FILE:
+        return
+    if len(prefetch_tasks) >= PREFETCH_MAX_ACTIVE:
+        logger.info(f"Prefetch budget full, user {user_id} downloads on demand")
+        return
+    
+    task = asyncio.create_task(prefetch_video(bot, user_id, chat_id, user_session))
+    user_session['prefetch'] = task
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+async def prefetch_video(bot: Bot, user_id: int, chat_id: int, user_session: Dict):
+    """Fill the session's downloaded_files and video_info, like the track menu would"""
+    trace = start_trace('prefetch', user_id)
+    video_source = {
+        'file_id': user_session['video_file_id'],
+        'chat_id': chat_id,
+        'video_message_id': user_session.get('video_message_id')
+    }
+    try:
+        input_path = await download_job_video(bot, video_source, trace, user_session['downloaded_files'])
+        with trace.span('ffprobe'):
+            video_info = await asyncio.to_thread(get_video_info, input_path)
+        if video_info:
+            user_session['video_info'] = video_info
+            user_session['input_path'] = input_path
+            trace.meta = video_meta(input_path, video_info)
+        trace.finish('ok')
+        
+        asyncio.get_running_loop().call_later(PREFETCH_TTL, expire_prefetch, user_id, user_session)
+    except asyncio.CancelledError:
+        trace.finish('cancelled')
+        raise
+    except Exception as e:
+        # Not fatal: the menu or job downloads the video itself
+        logger.error(f"Prefetch failed for user {user_id}: {e}")
+        trace.finish('error')
+    finally:
+        cost_model.record(trace.to_dict())
+
+async def wait_for_prefetch(user_session: Dict):
+    """Let a running prefetch finish, so its download and probe are reused"""
+    task = user_session.get('prefetch')
+    if task is None or task.done():
+        return
+    try:
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise  # The caller itself was cancelled
+
+def cancel_prefetch(user_session: Dict):
+    task = user_session.pop('prefetch', None)
+    if task is not None and not task.done():
+        task.cancel()
+
+def discard_session(user_id: int):
+    """Drop a user's previous video: stop its prefetch and delete its files unless a job uses them"""
+    user_session = user_sessions.get(user_id)
+    if user_session is None:
+        return
+    cancel_prefetch(user_session)
+    if not user_session.get('processing'):
+        for file_path in user_session.get('downloaded_files', []):
+            cleanup_files(file_path)
+        user_session['downloaded_files'] = []
+
+def expire_prefetch(user_id: int, user_session: Dict):
+    """Delete a prefetched file nobody used within PREFETCH_TTL"""
+    if user_session.get('processing') or not user_session.get('downloaded_files'):
+        return
+    logger.info(f"Prefetched video of user {user_id} expired")
+    for file_path in user_session['downloaded_files']:
+        cleanup_files(file_path)
+    user_session['downloaded_files'] = []
+
+# ===== SHARED JOB QUEUE =====
+def job_priority(job: Dict) -> float:
+    """Claim order for the shared queue: predicted cost with the same aging as the local scheduler"""
+    return job.get('predicted_seconds', 0) + job['created_at'] * SCHEDULER_AGING
+
+class SQLiteJobQueue:
+    """Job queue in an SQLite file, shared by frontend and workers on one host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " worker_id TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " created_at REAL NOT NULL,"
+                " heartbeat_at REAL,"
+                " finished_at REAL,"
+                " result TEXT,"
+                " priority REAL NOT NULL DEFAULT 0,"
+                " user_id INTEGER NOT NULL DEFAULT 0)"
+            )
+            for column in ("priority REAL NOT NULL DEFAULT 0", "user_id INTEGER NOT NULL DEFAULT 0"):
+                try:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass  # Column already exists
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_priority ON jobs (status, priority)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, job: Dict):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, payload, created_at, priority, user_id)"
+                " VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job['job_id'], json.dumps(job), job['created_at'], job_priority(job), job['user_id'])
+            )
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """Atomically take the queued job with the lowest aged predicted cost,
+        skipping users who already run USER_MAX_CONCURRENT_JOBS jobs"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT job_id, payload FROM jobs WHERE status = 'queued' AND user_id NOT IN ("
+                    " SELECT user_id FROM jobs WHERE status = 'running' GROUP BY user_id HAVING COUNT(*) >= ?)"
+                    " ORDER BY priority, created_at LIMIT 1",
+                    (USER_MAX_CONCURRENT_JOBS,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', worker_id = ?, attempts = attempts + 1,"
+                        " heartbeat_at = ? WHERE job_id = ?",
+                        (worker_id, now, row['job_id'])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return json.loads(row['payload']) if row is not None else None
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Refresh a running job; False if this worker no longer owns it"""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                (time.time(), job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, status: str, result: Dict):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ? WHERE job_id = ? AND worker_id = ?",
+                (status, time.time(), json.dumps(result), job_id, worker_id)
+            )
+
+    def requeue_stale(self, stale_after: float, max_attempts: int) -> List[Dict]:
+        """Re-queue running jobs whose worker died; returns the jobs that were given up"""
+        now = time.time()
+        given_up = []
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT job_id, payload, attempts FROM jobs WHERE status = 'running' AND heartbeat_at < ?",
+                    (now - stale_after,)
+                ).fetchall()
+                for row in rows:
+                    if row['attempts'] >= max_attempts:
+                        conn.execute(
+                            "UPDATE jobs SET status = 'failed', finished_at = ?, result = ? WHERE job_id = ?",
+                            (now, json.dumps({'error': 'worker lost'}), row['job_id'])
+                        )
+                        given_up.append(json.loads(row['payload']))
+                    else:
+                        conn.execute(
+                            "UPDATE jobs SET status = 'queued', worker_id = NULL WHERE job_id = ?",
+                            (row['job_id'],)
+                        )
+                conn.execute(
+                    "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?",
+                    (now - JOB_RETENTION,)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return given_up
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record['payload'] = json.loads(record['payload'])
+        record['result'] = json.loads(record['result']) if record['result'] else None
+        return record
+
+    def stats(self) -> Dict:
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            workers = conn.execute(
+                "SELECT COUNT(DISTINCT worker_id) FROM jobs WHERE status = 'running'"
+            ).fetchone()[0]
+        return {'queued': counts.get('queued', 0), 'running': counts.get('running', 0), 'workers': workers}
+
+    def user_stats(self) -> Dict[int, Dict[str, int]]:
+        """Queued and running job counts per user"""
+        usage = defaultdict(lambda: {'queued': 0, 'running': 0})
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT user_id, status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+                " GROUP BY user_id, status"
+            ).fetchall()
+        for user_id, status, count in rows:
+            usage[user_id][status] = count
+        return dict(usage)
+
+class MongoJobQueue:
+    """Job queue in a MongoDB collection, shared by workers on any host"""
+
+    def __init__(self, uri: str, database: str):
+        # Optional dependency, only needed for this backend
+        from pymongo import ASCENDING, MongoClient, ReturnDocument
+        self._return_after = ReturnDocument.AFTER
+        self.jobs = MongoClient(uri)[database]['jobs']
+        self.jobs.create_index([('status', ASCENDING), ('created_at', ASCENDING)])
+        self.jobs.create_index([('status', ASCENDING), ('priority', ASCENDING)])
+
+    def enqueue(self, job: Dict):
+        self.jobs.insert_one({
+            '_id': job['job_id'],
+            'status': 'queued',
+            'payload': job,
+            'attempts': 0,
+            'created_at': job['created_at'],
+            'priority': job_priority(job),
+            'user_id': job['user_id']
+        })
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """Atomically take the queued job with the lowest aged predicted cost,
+        skipping users who already run USER_MAX_CONCURRENT_JOBS jobs"""
+        # Racing workers can put a user one job over the limit, never more per worker
+        busy_users = [
+            row['_id'] for row in self.jobs.aggregate([
+                {'$match': {'status': 'running'}},
+                {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gte': USER_MAX_CONCURRENT_JOBS}}}
+            ])
+            if row['_id'] is not None
+        ]
+        doc = self.jobs.find_one_and_update(
+            {'status': 'queued', 'user_id': {'$nin': busy_users}},
+            {'$set': {'status': 'running', 'worker_id': worker_id, 'heartbeat_at': time.time()}, '$inc': {'attempts': 1}},
+            sort=[('priority', 1), ('created_at', 1)],
+            return_document=self._return_after
+        )
+        return doc['payload'] if doc else None
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Refresh a running job; False if this worker no longer owns it"""
+        result = self.jobs.update_one(
+            {'_id': job_id, 'worker_id': worker_id, 'status': 'running'},
+            {'$set': {'heartbeat_at': time.time()}}
+        )
+        return result.matched_count == 1
+
+    def complete(self, job_id: str, worker_id: str, status: str, result: Dict):
+        self.jobs.update_one(
+            {'_id': job_id, 'worker_id': worker_id},
+            {'$set': {'status': status, 'finished_at': time.time(), 'result': result}}
+        )
 
-def cleanup_files(*file_paths):
-    """Clean up temporary files - ENHANCED"""
-    for file_path in file_paths:
+    def requeue_stale(self, stale_after: float, max_attempts: int) -> List[Dict]:
+        """Re-queue running jobs whose worker died; returns the jobs that were given up"""
+        now = time.time()
+        cutoff = now - stale_after
+        given_up = []
+        for doc in self.jobs.find({'status': 'running', 'heartbeat_at': {'$lt': cutoff}}):
+            stale = {'_id': doc['_id'], 'status': 'running', 'heartbeat_at': {'$lt': cutoff}}
+            if doc['attempts'] >= max_attempts:
+                result = self.jobs.update_one(
+                    stale, {'$set': {'status': 'failed', 'finished_at': now, 'result': {'error': 'worker lost'}}}
+                )
+                if result.modified_count:
+                    given_up.append(doc['payload'])
+            else:
+                self.jobs.update_one(stale, {'$set': {'status': 'queued', 'worker_id': None}})
+        self.jobs.delete_many({'status': {'$nin': ['queued', 'running']}, 'finished_at': {'$lt': now - JOB_RETENTION}})
+        return given_up
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        doc = self.jobs.find_one({'_id': job_id})
+        if doc:
+            doc['job_id'] = doc.pop('_id')
+        return doc
+
+    def stats(self) -> Dict:
+        counts = {row['_id']: row['count'] for row in self.jobs.aggregate(
+            [{'$match': {'status': {'$in': ['queued', 'running']}}}, {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+        )}
+        workers = len(self.jobs.distinct('worker_id', {'status': 'running'}))
+        return {'queued': counts.get('queued', 0), 'running': counts.get('running', 0), 'workers': workers}
+
+    def user_stats(self) -> Dict[int, Dict[str, int]]:
+        """Queued and running job counts per user"""
+        usage = defaultdict(lambda: {'queued': 0, 'running': 0})
+        for row in self.jobs.aggregate([
+            {'$match': {'status': {'$in': ['queued', 'running']}}},
+            {'$group': {'_id': {'user_id': '$user_id', 'status': '$status'}, 'count': {'$sum': 1}}}
+        ]):
+            usage[row['_id'].get('user_id', 0)][row['_id']['status']] = row['count']
+        return dict(usage)
+
+def create_shared_queue():
+    """Shared queue for the configured backend (None = run jobs in-process)"""
+    if JOB_QUEUE_BACKEND == "sqlite":
+        return SQLiteJobQueue(JOB_QUEUE_SQLITE_PATH)
+    if JOB_QUEUE_BACKEND == "mongodb":
+        return MongoJobQueue(MONGO_URI, MONGO_DATABASE)
+    return None
+
+async def requeue_stale_jobs(bot: Bot):
+    """Re-queue jobs of dead workers and tell users about jobs out of attempts"""
+    given_up = await asyncio.to_thread(shared_queue.requeue_stale, WORKER_STALE_AFTER, MAX_JOB_ATTEMPTS)
+    for job in given_up:
+        logger.error(f"Job {job['job_id']} failed: worker lost {MAX_JOB_ATTEMPTS} times")
         try:
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Cleaned up: {file_path}")
+            await bot.edit_message_text(
+                chat_id=job['chat_id'],
+                message_id=job['status_message_id'],
+                text=f"{EMOJI_ERROR} Processing failed: worker lost. (job {job['job_id']})"
+            )
         except Exception as e:
-            logger.error(f"Error cleaning up file {file_path}: {e}")
+            logger.error(f"Error reporting lost job {job['job_id']}: {e}")
+
+async def requeue_stale_jobs_loop(bot: Bot):
+    """Frontend side of worker failure detection"""
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            await requeue_stale_jobs(bot)
+        except Exception as e:
+            logger.error(f"Error re-queueing stale jobs: {e}")
 
 # ===== KEYBOARD GENERATORS =====
 def get_main_menu_keyboard() -> InlineKeyboardMarkup:
@@ -250,6 +3502,7 @@ def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("🎵 Remove Audio Tracks", callback_data="remaudio")],
         [InlineKeyboardButton("📝 Remove Subtitle Tracks", callback_data="remsubtitles")],
+        [InlineKeyboardButton("📤 Extract Tracks", callback_data="extract")],
         [InlineKeyboardButton("🗑️ Remove All Audio", callback_data="remallaudio")],
         [InlineKeyboardButton("🗑️ Remove All Subtitles", callback_data="remallsubtitles")],
         [InlineKeyboardButton("🔥 Remove All Tracks", callback_data="remall")],
@@ -258,7 +3511,7 @@ def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_track_selection_keyboard(tracks: List[Dict], selected_tracks: Set[int], page: int, tracks_per_page: int = 8) -> InlineKeyboardMarkup:
+def get_track_selection_keyboard(tracks: List[Dict], selected_tracks: Set[int], page: int, tracks_per_page: int = 8, offer_extract: bool = False) -> InlineKeyboardMarkup:
     """Generate track selection keyboard with pagination"""
     keyboard = []
     
@@ -294,6 +3547,10 @@ def get_track_selection_keyboard(tracks: List[Dict], selected_tracks: Set[int],
     if nav_buttons:
         keyboard.append(nav_buttons)
     
+    # Removal menus can add extracted tracks to the same job
+    if offer_extract:
+        keyboard.append([InlineKeyboardButton("📤 Also extract tracks", callback_data="extract_also")])
+    
     # Add action buttons
     selected_count = len(selected_tracks)
     action_buttons = [
@@ -322,8 +3579,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "*PRIVATE MODE* - Optimized for performance\n\n"
         "⚡ *Features:*\n"
         "• Remove specific audio/subtitle tracks\n"
+        "• Extract tracks to separate files in the same pass\n"
         "• Fast processing with stream copy\n"
-        "• Support up to 950MB files\n"
+        f"• Support up to {MAX_FILE_SIZE // (1024*1024)}MB files\n"
         "• Concurrent processing: 6 tasks\n"
         "• Automatic file cleanup\n\n"
         "Send a video or use the menu below!"
@@ -345,13 +3603,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /trackkiller - Main track removal\n"
         "• /remaudio - Remove audio tracks\n"
         "• /remsubtitles - Remove subtitle tracks\n"
+        "• /extract - Extract tracks to separate files\n"
         "• /remallaudio - Remove all audio\n"
         "• /remallsubtitles - Remove all subtitles\n"
         "• /remall - Remove all tracks\n"
         "• /cancel - Cancel current task\n"
         "• /status - System status\n\n"
         "*Limits:*\n"
-        "• Max file size: 950MB\n"
+        f"• Max file size: {MAX_FILE_SIZE // (1024*1024)}MB\n"
         "• Max concurrent tasks: 6\n"
         "• Automatic file cleanup\n"
     )
@@ -376,9 +3635,30 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"*Active Sessions:* {len(user_sessions)}\n"
         f"*Bot Mode:* {BOT_MODE.upper()}\n"
         f"*Max File Size:* {MAX_FILE_SIZE // (1024*1024)}MB\n"
-        f"*Max Processes:* {MAX_CONCURRENT_PROCESSES}"
+        f"*Max Processes:* {MAX_CONCURRENT_PROCESSES}\n"
+        f"{loop_watchdog.summary()}\n"
+        f"{api_scheduler.summary()}\n"
+        f"🧮 Cost model: {cost_model.sample_count()} samples"
     )
     
+    queue_usage = None
+    if shared_queue is None:
+        status_text += f" | {scheduler.waiting} waiting for a slot"
+    else:
+        queue_stats = await asyncio.to_thread(shared_queue.stats)
+        queue_usage = await asyncio.to_thread(shared_queue.user_stats)
+        status_text += (
+            f"\n📥 Queue: {queue_stats['queued']} queued | "
+            f"{queue_stats['running']} running on {queue_stats['workers']} worker(s)"
+        )
+    
+    if transfer_pool is not None:
+        status_text += f"\n{transfer_pool.summary()}"
+    
+    quota_status = get_quota_status(queue_usage)
+    if quota_status:
+        status_text += f"\n\n*User Quotas:*\n{quota_status}"
+    
     await update.message.reply_text(
         status_text,
         parse_mode=ParseMode.MARKDOWN,
@@ -406,15 +3686,20 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Store video info in user session
+    discard_session(user_id)
     user_sessions[user_id] = {
         'video_file_id': video.file_id,
+        'file_size': video.file_size or 0,
         'video_message_id': update.message.message_id,
         'selected_audio_tracks': set(),
         'selected_subtitle_tracks': set(),
-        'processing': False,
+        'selected_extract_tracks': set(),
+        'processing': 0,
         'downloaded_files': []  # Track files for cleanup
     }
     
+    start_prefetch(context.bot, user_id, update.effective_chat.id)
+    
     await update.message.reply_text(
         "🎬 Video received! Choose an option:",
         reply_markup=get_main_menu_keyboard()
@@ -441,12 +3726,15 @@ async def track_killer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Store video info
+    discard_session(user_id)
     user_sessions[user_id] = {
         'video_file_id': video.file_id,
+        'file_size': video.file_size or 0,
         'video_message_id': replied_message.message_id,
         'selected_audio_tracks': set(),
         'selected_subtitle_tracks': set(),
-        'processing': False,
+        'selected_extract_tracks': set(),
+        'processing': 0,
         'downloaded_files': []
     }
     
@@ -460,6 +3748,10 @@ async def rem_subtitles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /remsubtitles command"""
     await handle_track_removal_command(update, context, 'subtitles')
 
+async def extract_tracks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /extract command"""
+    await handle_track_removal_command(update, context, 'extract')
+
 async def handle_track_removal_command(update: Update, context: ContextTypes.DEFAULT_TYPE, track_type: str):
     """Handle track removal commands"""
     user_id = update.effective_user.id
@@ -474,10 +3766,12 @@ async def handle_track_removal_command(update: Update, context: ContextTypes.DEF
     
     user_session = user_sessions[user_id]
     
-    if track_type == 'audio':
-        user_session['selected_subtitle_tracks'] = set()
-    else:
+    if track_type in ('subtitles', 'extract'):
         user_session['selected_audio_tracks'] = set()
+    if track_type in ('audio', 'extract'):
+        user_session['selected_subtitle_tracks'] = set()
+    if track_type != 'extract':
+        user_session['selected_extract_tracks'] = set()
     
     await show_track_selection(update, context, user_id, track_type)
 
@@ -506,94 +3800,35 @@ async def process_remove_all(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
     
     # Check system capacity
-    if not await can_process_video():
+    if not await reserve_job_slot():
         await update.message.reply_text(
             f"❌ System busy. Please wait...\n{get_system_status()}"
         )
         return
     
-    user_session = user_sessions[user_id]
-    user_session['processing'] = True
-    
-    processing_msg = await update.message.reply_text(
-        f"{EMOJI_LOADING} Processing your video...\n{get_system_status()}"
-    )
-    
-    input_path = None
-    output_path = None
-    
+    file_size = user_sessions[user_id].get('file_size', 0)
+    charged = False
+    job = None
     try:
-        await increment_process_count()
-        
-        # Download video
-        video_file = await context.bot.get_file(user_session['video_file_id'])
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as input_file:
-            await video_file.download_to_drive(input_file.name)
-            input_path = input_file.name
-            user_session['downloaded_files'].append(input_path)
-        
-        output_path = input_path.replace('.mp4', '_processed.mp4')
-        
-        # Get video info
-        video_info = get_video_info(input_path)
-        audio_tracks = get_audio_tracks(video_info)
-        subtitle_tracks = get_subtitle_tracks(video_info)
-        
-        audio_tracks_to_remove = set()
-        subtitle_tracks_to_remove = set()
-        
-        if remove_audio:
-            audio_tracks_to_remove = {track['index'] for track in audio_tracks}
-        
-        if remove_subtitles:
-            subtitle_tracks_to_remove = {track['index'] for track in subtitle_tracks}
+        quota_error = await check_user_quota(user_id, file_size)
+        if quota_error:
+            await update.message.reply_text(quota_error)
+            return
+        charged = True
         
-        # Update processing message
-        await processing_msg.edit_text(
-            f"{EMOJI_LOADING} Removing tracks...\n"
-            f"Audio: {len(audio_tracks_to_remove)} tracks\n"
-            f"Subtitles: {len(subtitle_tracks_to_remove)} tracks\n"
-            f"{get_system_status()}"
+        processing_msg = await update.message.reply_text(
+            f"{EMOJI_LOADING} Processing your video...\n{get_system_status()}"
         )
         
-        # Process video
-        success = remove_tracks(input_path, output_path, audio_tracks_to_remove, subtitle_tracks_to_remove)
-        
-        if success and os.path.exists(output_path):
-            # Send processed video
-            file_size = os.path.getsize(output_path) / (1024 * 1024)
-            with open(output_path, 'rb') as video_file:
-                await update.message.reply_document(
-                    document=InputFile(
-                        video_file, 
-                        filename=f"trackkiller_{datetime.now().strftime('%H%M%S')}.mp4"
-                    ),
-                    caption=(
-                        f"{EMOJI_SUCCESS} Processing completed!\n"
-                        f"📁 Output: {file_size:.1f}MB\n"
-                        f"🎵 Audio removed: {len(audio_tracks_to_remove)}\n"
-                        f"📝 Subtitles removed: {len(subtitle_tracks_to_remove)}"
-                    )
-                )
-            await processing_msg.delete()
-        else:
-            await processing_msg.edit_text(f"{EMOJI_ERROR} Error processing video.")
-        
-    except Exception as e:
-        logger.error(f"Error in process_remove_all: {e}")
-        await processing_msg.edit_text(f"{EMOJI_ERROR} Processing failed: {str(e)}")
-    
+        job = build_job(
+            'remove_all', user_id, processing_msg, user_sessions[user_id],
+            remove_all_audio=remove_audio, remove_all_subtitles=remove_subtitles
+        )
+        await submit_job(context, job)
     finally:
-        # CLEANUP ALL FILES
-        cleanup_files(input_path, output_path)
-        if user_id in user_sessions:
-            for file_path in user_session.get('downloaded_files', []):
-                cleanup_files(file_path)
-            user_session['downloaded_files'] = []
-            user_session['processing'] = False
-        
-        await decrement_process_count()
+        if charged and job is None:
+            refund_user_bytes(user_id, file_size)  # submit_job refunds once it has the job
+        await release_job_slot()
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /cancel command"""
@@ -602,10 +3837,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in user_sessions:
         # Cleanup files
         user_session = user_sessions[user_id]
+        cancel_prefetch(user_session)
         for file_path in user_session.get('downloaded_files', []):
             cleanup_files(file_path)
         user_session['downloaded_files'] = []
-        user_session['processing'] = False
         
         await update.message.reply_text("✅ Operation cancelled and files cleaned up.")
     else:
@@ -622,25 +3857,51 @@ async def show_track_selection(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     
     input_path = None
+    trace = start_trace('analyze', user_id)
+    
+    # Session keys are selected_audio_tracks / selected_subtitle_tracks / selected_extract_tracks
+    if track_type == 'subtitles':
+        track_type = 'subtitle'
+    user_session.setdefault('selected_extract_tracks', set())
     
     try:
-        video_file = await context.bot.get_file(user_session['video_file_id'])
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
-            await video_file.download_to_drive(temp_file.name)
-            input_path = temp_file.name
-            user_session['downloaded_files'].append(input_path)
-        
-        video_info = get_video_info(input_path)
+        # Probe once per video (or reuse the prefetch); later menus reuse it
+        await wait_for_prefetch(user_session)
+        video_info = user_session.get('video_info')
+        if not video_info:
+            video_source = {
+                'file_id': user_session['video_file_id'],
+                'chat_id': update.effective_chat.id,
+                'video_message_id': user_session.get('video_message_id')
+            }
+            input_path = await download_job_video(
+                context.bot, video_source, trace, user_session['downloaded_files']
+            )
+            
+            with trace.span('ffprobe'):
+                video_info = await asyncio.to_thread(get_video_info, input_path)
+            user_session['video_info'] = video_info
+            if video_info:
+                user_session['input_path'] = input_path
         
         if track_type == 'audio':
             tracks = get_audio_tracks(video_info)
             title = "🎵 Select Audio Tracks to Remove"
-        else:
+        elif track_type == 'subtitle':
             tracks = get_subtitle_tracks(video_info)
             title = "📝 Select Subtitle Tracks to Remove"
+        else:
+            tracks = [
+                dict(track, display_name=f"{EMOJI_AUDIO}{track['display_name']}")
+                for track in get_audio_tracks(video_info)
+            ] + [
+                dict(track, display_name=f"{EMOJI_SUBTITLE}{track['display_name']}")
+                for track in get_subtitle_tracks(video_info)
+            ]
+            title = "📤 Select Tracks to Extract"
         
         if not tracks:
+            trace.finish('no_tracks')
             await processing_msg.edit_text(f"❌ No {track_type} tracks found.")
             return
         
@@ -651,7 +3912,8 @@ async def show_track_selection(update: Update, context: ContextTypes.DEFAULT_TYP
         keyboard = get_track_selection_keyboard(
             tracks, 
             user_session[f'selected_{track_type}_tracks'],
-            0
+            0,
+            offer_extract=track_type != 'extract'
         )
         
         message_text = (
@@ -662,13 +3924,16 @@ async def show_track_selection(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         
         await processing_msg.edit_text(message_text, reply_markup=keyboard)
+        trace.finish('ok')
         
     except Exception as e:
         logger.error(f"Error in show_track_selection: {e}")
-        await processing_msg.edit_text(f"{EMOJI_ERROR} Analysis failed.")
+        trace.finish('error')
+        await processing_msg.edit_text(f"{EMOJI_ERROR} Analysis failed. (job {trace.trace_id})")
     
     finally:
         # Input file is kept for processing, will be cleaned up later
+        trace.finish('cancelled')
 
 # ===== CALLBACK QUERY HANDLERS =====
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -701,7 +3966,15 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             user_session['selected_subtitle_tracks'] = set()
         else:
             user_session['selected_audio_tracks'] = set()
+        user_session['selected_extract_tracks'] = set()
         await show_track_selection(update, context, user_id, track_type)
+    elif data == "extract":
+        user_session['selected_audio_tracks'] = set()
+        user_session['selected_subtitle_tracks'] = set()
+        await show_track_selection(update, context, user_id, 'extract')
+    elif data == "extract_also":
+        # Keeps the removal selection just made, so both happen in one job
+        await show_track_selection(update, context, user_id, 'extract')
     elif data in ["remallaudio", "remallsubtitles", "remall"]:
         remove_audio = data in ["remallaudio", "remall"]
         remove_subtitles = data in ["remallsubtitles", "remall"]
@@ -729,7 +4002,8 @@ async def handle_track_selection(query, user_session, data):
     keyboard = get_track_selection_keyboard(
         user_session['current_tracks'],
         selected_tracks,
-        user_session['current_page']
+        user_session['current_page'],
+        offer_extract=track_type != 'extract'
     )
     
     await query.edit_message_reply_markup(reply_markup=keyboard)
@@ -743,7 +4017,8 @@ async def handle_page_navigation(query, user_session, data):
     keyboard = get_track_selection_keyboard(
         user_session['current_tracks'],
         user_session[f'selected_{track_type}_tracks'],
-        page
+        page,
+        offer_extract=track_type != 'extract'
     )
     
     await query.edit_message_reply_markup(reply_markup=keyboard)
@@ -752,35 +4027,51 @@ async def handle_done_selection(query, context: ContextTypes.DEFAULT_TYPE, user_
     """Handle done selection and process video"""
     user_session = user_sessions[user_id]
     
-    # Check system capacity
-    if not await can_process_video():
-        await query.edit_message_text(
-            f"❌ System busy. Please wait...\n{get_system_status()}"
-        )
-        return
-    
-    track_type = user_session['current_track_type']
-    selected_count = len(user_session[f'selected_{track_type}_tracks'])
+    remove_count = len(user_session['selected_audio_tracks']) + len(user_session['selected_subtitle_tracks'])
+    extract_count = len(user_session.get('selected_extract_tracks', set()))
     
-    if selected_count == 0:
+    if remove_count + extract_count == 0:
         await query.edit_message_text(
             "❌ No tracks selected. Please select at least one track.",
             reply_markup=get_main_menu_keyboard()
         )
         return
     
-    processing_msg = await query.edit_message_text(
-        f"{EMOJI_LOADING} Starting processing...\n"
-        f"Selected: {selected_count} {track_type} track(s)\n"
-        f"{get_system_status()}"
-    )
+    # Check system capacity
+    if not await reserve_job_slot():
+        await query.edit_message_text(
+            f"❌ System busy. Please wait...\n{get_system_status()}"
+        )
+        return
     
-    await process_selected_tracks(processing_msg, context, user_id)
+    file_size = user_session.get('file_size', 0)
+    charged = False
+    job = None
+    try:
+        quota_error = await check_user_quota(user_id, file_size)
+        if quota_error:
+            await query.edit_message_text(quota_error)
+            return
+        charged = True
+        
+        processing_msg = await query.edit_message_text(
+            f"{EMOJI_LOADING} Starting processing...\n"
+            f"Selected: {remove_count} to remove, {extract_count} to extract\n"
+            f"{get_system_status()}"
+        )
+        
+        job = build_job('remove_selected', user_id, processing_msg, user_session)
+        await submit_job(context, job)
+    finally:
+        if charged and job is None:
+            refund_user_bytes(user_id, file_size)  # submit_job refunds once it has the job
+        await release_job_slot()
 
 async def handle_cancel_selection(query, user_id: int):
     """Handle cancel selection with cleanup"""
     if user_id in user_sessions:
         user_session = user_sessions[user_id]
+        cancel_prefetch(user_session)
         for file_path in user_session.get('downloaded_files', []):
             cleanup_files(file_path)
         user_session['downloaded_files'] = []
@@ -790,165 +4081,38 @@ async def handle_cancel_selection(query, user_id: int):
         reply_markup=get_main_menu_keyboard()
     )
 
-async def process_selected_tracks(processing_msg, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Process video with selected tracks"""
-    user_session = user_sessions[user_id]
-    user_session['processing'] = True
-    
-    input_path = None
-    output_path = None
-    
-    try:
-        await increment_process_count()
-        
-        # Download video if not already downloaded
-        if not user_session.get('downloaded_files'):
-            video_file = await context.bot.get_file(user_session['video_file_id'])
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as input_file:
-                await video_file.download_to_drive(input_file.name)
-                input_path = input_file.name
-                user_session['downloaded_files'].append(input_path)
-        else:
-            input_path = user_session['downloaded_files'][0]
-        
-        output_path = input_path.replace('.mp4', '_processed.mp4')
-        
-        # Update processing message
-        audio_count = len(user_session['selected_audio_tracks'])
-        sub_count = len(user_session['selected_subtitle_tracks'])
-        
-        await processing_msg.edit_text(
-            f"{EMOJI_LOADING} Removing tracks...\n"
-            f"🎵 Audio: {audio_count} tracks\n"
-            f"📝 Subtitles: {sub_count} tracks\n"
-            f"{get_system_status()}"
-        )
-        
-        # Process video
-        success = remove_tracks(
-            input_path, 
-            output_path, 
-            user_session['selected_audio_tracks'],
-            user_session['selected_subtitle_tracks']
-        )
-        
-        if success and os.path.exists(output_path):
-            # Send processed video
-            file_size = os.path.getsize(output_path) / (1024 * 1024)
-            with open(output_path, 'rb') as video_file:
-                await context.bot.send_document(
-                    chat_id=processing_msg.chat_id,
-                    document=InputFile(
-                        video_file, 
-                        filename=f"trackkiller_{datetime.now().strftime('%H%M%S')}.mp4"
-                    ),
-                    caption=(
-                        f"{EMOJI_SUCCESS} Processing completed!\n"
-                        f"📁 Output: {file_size:.1f}MB\n"
-                        f"🎵 Audio removed: {audio_count}\n"
-                        f"📝 Subtitles removed: {sub_count}"
-                    )
-                )
-            await processing_msg.delete()
-        else:
-            await processing_msg.edit_text(f"{EMOJI_ERROR} Processing failed.")
-        
-    except Exception as e:
-        logger.error(f"Error in process_selected_tracks: {e}")
-        await processing_msg.edit_text(f"{EMOJI_ERROR} Error: {str(e)}")
-    
-    finally:
-        # CLEANUP ALL FILES
-        cleanup_files(input_path, output_path)
-        if user_id in user_sessions:
-            for file_path in user_session.get('downloaded_files', []):
-                cleanup_files(file_path)
-            user_session['downloaded_files'] = []
-            user_session['processing'] = False
-        
-        await decrement_process_count()
-
 async def process_remove_all_callback(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, remove_audio: bool, remove_subtitles: bool):
     """Process remove all tracks from callback"""
-    user_session = user_sessions[user_id]
-    user_session['processing'] = True
-    
-    processing_msg = await query.edit_message_text(
-        f"{EMOJI_LOADING} Starting processing...\n{get_system_status()}"
-    )
-    
-    input_path = None
-    output_path = None
+    # Check system capacity
+    if not await reserve_job_slot():
+        await query.edit_message_text(
+            f"❌ System busy. Please wait...\n{get_system_status()}"
+        )
+        return
     
+    file_size = user_sessions[user_id].get('file_size', 0)
+    charged = False
+    job = None
     try:
-        await increment_process_count()
-        
-        # Download video
-        video_file = await context.bot.get_file(user_session['video_file_id'])
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as input_file:
-            await video_file.download_to_drive(input_file.name)
-            input_path = input_file.name
-            user_session['downloaded_files'].append(input_path)
-        
-        output_path = input_path.replace('.mp4', '_processed.mp4')
-        
-        # Get video info
-        video_info = get_video_info(input_path)
-        audio_tracks = get_audio_tracks(video_info)
-        subtitle_tracks = get_subtitle_tracks(video_info)
-        
-        audio_tracks_to_remove = set()
-        subtitle_tracks_to_remove = set()
-        
-        if remove_audio:
-            audio_tracks_to_remove = {track['index'] for track in audio_tracks}
-        
-        if remove_subtitles:
-            subtitle_tracks_to_remove = {track['index'] for track in subtitle_tracks}
+        quota_error = await check_user_quota(user_id, file_size)
+        if quota_error:
+            await query.edit_message_text(quota_error)
+            return
+        charged = True
         
-        await processing_msg.edit_text(
-            f"{EMOJI_LOADING} Removing tracks...\n"
-            f"Audio: {len(audio_tracks_to_remove)} tracks\n"
-            f"Subtitles: {len(subtitle_tracks_to_remove)} tracks\n"
-            f"{get_system_status()}"
+        processing_msg = await query.edit_message_text(
+            f"{EMOJI_LOADING} Starting processing...\n{get_system_status()}"
         )
         
-        success = remove_tracks(input_path, output_path, audio_tracks_to_remove, subtitle_tracks_to_remove)
-        
-        if success and os.path.exists(output_path):
-            file_size = os.path.getsize(output_path) / (1024 * 1024)
-            with open(output_path, 'rb') as video_file:
-                await context.bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=InputFile(
-                        video_file, 
-                        filename=f"trackkiller_{datetime.now().strftime('%H%M%S')}.mp4"
-                    ),
-                    caption=(
-                        f"{EMOJI_SUCCESS} Processing completed!\n"
-                        f"📁 Output: {file_size:.1f}MB\n"
-                        f"🎵 Audio removed: {len(audio_tracks_to_remove)}\n"
-                        f"📝 Subtitles removed: {len(subtitle_tracks_to_remove)}"
-                    )
-                )
-            await processing_msg.delete()
-        else:
-            await processing_msg.edit_text(f"{EMOJI_ERROR} Processing failed.")
-        
-    except Exception as e:
-        logger.error(f"Error in process_remove_all_callback: {e}")
-        await processing_msg.edit_text(f"{EMOJI_ERROR} Error: {str(e)}")
-    
+        job = build_job(
+            'remove_all', user_id, processing_msg, user_sessions[user_id],
+            remove_all_audio=remove_audio, remove_all_subtitles=remove_subtitles
+        )
+        await submit_job(context, job)
     finally:
-        cleanup_files(input_path, output_path)
-        if user_id in user_sessions:
-            for file_path in user_session.get('downloaded_files', []):
-                cleanup_files(file_path)
-            user_session['downloaded_files'] = []
-            user_session['processing'] = False
-        
-        await decrement_process_count()
+        if charged and job is None:
+            refund_user_bytes(user_id, file_size)  # submit_job refunds once it has the job
+        await release_job_slot()
 
 # ===== ADMIN MANAGEMENT =====
 async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1007,6 +4171,73 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_list = "\n".join([f"• {admin_id}" for admin_id in admins])
     await update.message.reply_text(f"👑 Admins:\n{admin_list}")
 
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show job trace waterfalls (Owner only)"""
+    user_id = update.effective_user.id
+    
+    if user_id != OWNER_ID:
+        await update.message.reply_text("❌ Owner access required.")
+        return
+    
+    if context.args:
+        trace_id = context.args[0].strip().lower()
+        if trace_id in recent_traces:
+            traces = [recent_traces[trace_id].to_dict()]
+        else:
+            record = await asyncio.to_thread(load_trace_from_log, trace_id)
+            if not record and shared_queue is not None:
+                # Jobs run by workers report their trace back through the queue
+                queued_job = await asyncio.to_thread(shared_queue.get, trace_id)
+                if queued_job and queued_job.get('result') and 'spans' in queued_job['result']:
+                    record = queued_job['result']
+            if not record:
+                await update.message.reply_text(f"❌ No trace found for job {trace_id}.")
+                return
+            traces = [record]
+        header = f"🔎 Trace {trace_id}"
+    else:
+        # Slowest finished jobs first
+        finished = [t.to_dict() for t in recent_traces.values() if t.duration is not None]
+        if not finished:
+            await update.message.reply_text("ℹ️ No finished jobs traced yet.\nUsage: /trace <job>")
+            return
+        traces = sorted(finished, key=lambda t: t['duration'], reverse=True)[:5]
+        header = f"🐢 Slowest {len(traces)} of {len(finished)} recent jobs"
+    
+    for text in pack_pre_messages(header, [format_trace_waterfall(t) for t in traces]):
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Capture a sampling profile of the running bot (Owner only)"""
+    user_id = update.effective_user.id
+    
+    if user_id != OWNER_ID:
+        await update.message.reply_text("❌ Owner access required.")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    await update.message.reply_text(f"{EMOJI_LOADING} Profiling for {seconds}s...")
+    folded, samples = await asyncio.to_thread(sample_profile, seconds, PROFILE_SAMPLE_INTERVAL)
+    
+    caption = f"📈 Profile: {seconds}s, {samples} samples (folded stacks for flamegraph/speedscope)"
+    hottest = summarize_profile(folded)
+    if hottest:
+        caption += f"\n\nEvent loop hot spots:\n{hottest}"
+    
+    await update.message.reply_document(
+        document=InputFile(
+            io.BytesIO(folded.encode('utf-8')),
+            filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded.txt"
+        ),
+        caption=caption[:1024]
+    )
+
 # ===== ERROR HANDLER =====
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors"""
@@ -1020,19 +4251,252 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in error handler: {e}")
 
+# ===== APPLICATION LIFECYCLE =====
+async def post_init(application: Application):
+    """Start background tasks once the event loop is running"""
+    loop_watchdog.start()
+    await asyncio.to_thread(cost_model.load_history)
+    await start_transfer_pool(application.bot)
+    
+    if shared_queue is not None:
+        task = asyncio.create_task(requeue_stale_jobs_loop(application.bot))
+        background_tasks.add(task)
+
+async def post_shutdown(application: Application):
+    """Stop background tasks"""
+    loop_watchdog.stop()
+    for task in background_tasks:
+        task.cancel()
+    await stop_transfer_pool()
+
+# ===== WEBHOOK SERVER =====
+async def webhook_handler(request: web.Request) -> web.Response:
+    """Receive an update from Telegram and hand it to the application"""
+    received_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(received_token, request.app['secret_token']):
+        logger.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+        return web.Response(status=403)
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    
+    application = request.app['application']
+    update = Update.de_json(data, application.bot)
+    # Acknowledge right away; handlers run on the application's update queue
+    await application.update_queue.put(update)
+    return web.Response()
+
+async def webhook_health(request: web.Request) -> web.Response:
+    """Health check endpoint for the reverse proxy"""
+    return web.json_response({'status': 'ok', 'processes': current_processes})
+
+async def run_webhook(application: Application):
+    """Serve updates over an aiohttp webhook until SIGINT/SIGTERM"""
+    secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    
+    web_app = web.Application()
+    web_app['application'] = application
+    web_app['secret_token'] = secret_token
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    web_app.router.add_get('/healthz', webhook_health)
+    
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Not supported on Windows
+    
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        # Start listening before registering the webhook so no update is lost
+        await site.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"Webhook set to {WEBHOOK_URL}, listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        
+        try:
+            await stop_event.wait()
+        finally:
+            # The webhook stays registered so Telegram queues updates until
+            # the next start; switching to polling deletes it automatically.
+            await runner.cleanup()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+# ===== WORKER PROCESS =====
+def create_bot() -> Bot:
+    """Standalone Bot for worker processes (same API server as the frontend)"""
+    if LOCAL_MODE:
+        return ExtBot(
+            BOT_TOKEN, base_url=LOCAL_BOT_API_URL, base_file_url=LOCAL_BOT_API_FILE_URL,
+            local_mode=True, rate_limiter=api_scheduler
+        )
+    return ExtBot(BOT_TOKEN, rate_limiter=api_scheduler)
+
+async def keep_job_alive(job_id: str, worker_id: str, job_task: asyncio.Task):
+    """Heartbeat a claimed job; stop working on it if it was handed to another worker"""
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            still_owned = await asyncio.to_thread(shared_queue.heartbeat, job_id, worker_id)
+        except Exception as e:
+            logger.error(f"Heartbeat failed for job {job_id}: {e}")
+            continue
+        if not still_owned:
+            logger.warning(f"Job {job_id} was re-queued elsewhere, stopping")
+            job_task.cancel()
+            return
+
+async def process_claimed_job(bot: Bot, job: Dict, worker_id: str):
+    """Run one claimed job and report the result back to the queue"""
+    heartbeat = asyncio.create_task(keep_job_alive(job['job_id'], worker_id, asyncio.current_task()))
+    await increment_process_count()
+    
+    try:
+        trace = await run_job(bot, job)
+        status = 'done' if trace.status == 'ok' else 'failed'
+        await asyncio.to_thread(shared_queue.complete, job['job_id'], worker_id, status, trace.to_dict())
+    except asyncio.CancelledError:
+        pass  # Another worker owns the job now
+    except Exception as e:
+        logger.error(f"Error in worker job {job['job_id']}: {e}")
+    finally:
+        heartbeat.cancel()
+        await decrement_process_count()
+
+async def run_worker():
+    """Claim and process jobs from the shared queue until SIGINT/SIGTERM"""
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    slots = asyncio.Semaphore(MAX_CONCURRENT_PROCESSES)
+    running: Set[asyncio.Task] = set()
+    last_requeue_check = 0.0
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Not supported on Windows
+    
+    loop_watchdog.start()
+    await asyncio.to_thread(cost_model.load_history)
+    
+    async with create_bot() as bot:
+        await start_transfer_pool(bot)
+        logger.info(f"Worker {worker_id} started with {MAX_CONCURRENT_PROCESSES} slots")
+        
+        while not stop_event.is_set():
+            if time.monotonic() - last_requeue_check > WORKER_HEARTBEAT_INTERVAL:
+                last_requeue_check = time.monotonic()
+                try:
+                    await requeue_stale_jobs(bot)
+                except Exception as e:
+                    logger.error(f"Error re-queueing stale jobs: {e}")
+            
+            await slots.acquire()
+            try:
+                job = await asyncio.to_thread(shared_queue.claim, worker_id)
+            except Exception as e:
+                logger.error(f"Error claiming job: {e}")
+                job = None
+            
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stop_event.wait(), WORKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            logger.info(f"Worker {worker_id} claimed job {job['job_id']}")
+            task = asyncio.create_task(process_claimed_job(bot, job, worker_id))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+        
+        if running:
+            logger.info(f"Waiting for {len(running)} running job(s) to finish")
+            await asyncio.gather(*running, return_exceptions=True)
+        await stop_transfer_pool()
+    
+    loop_watchdog.stop()
+
 # ===== MAIN FUNCTION =====
 def main():
-    """Start the bot"""
-    # Check if ffmpeg is available
-    try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        print("✅ FFmpeg is available")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    """Start the bot (or a job worker with `python bot.py worker`)"""
+    global shared_queue
+    worker_mode = len(sys.argv) > 1 and sys.argv[1] == "worker"
+    
+    # Check if ffmpeg is available (capabilities are cached per ffmpeg build)
+    if not load_ffmpeg_capabilities():
         print("❌ FFmpeg is not installed. Please install FFmpeg.")
         return
+    print(f"✅ FFmpeg {ffmpeg_capabilities['version']} is available")
+    
+    if JOB_QUEUE_BACKEND not in ("local", "sqlite", "mongodb"):
+        print(f"❌ Unknown JOB_QUEUE_BACKEND: {JOB_QUEUE_BACKEND}")
+        return
+    
+    if worker_mode and JOB_QUEUE_BACKEND == "local":
+        print("❌ Worker mode needs JOB_QUEUE_BACKEND = \"sqlite\" or \"mongodb\".")
+        return
+    
+    shared_queue = create_shared_queue()
+    cleanup_stale_scratch()
+    
+    if worker_mode:
+        print(f"👷 Track Killer worker running ({JOB_QUEUE_BACKEND} queue)...")
+        asyncio.run(run_worker())
+        return
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    if DELIVERY_MODE not in ("polling", "webhook"):
+        print(f"❌ Unknown DELIVERY_MODE: {DELIVERY_MODE}")
+        return
+    
+    if DELIVERY_MODE == "webhook" and not WEBHOOK_URL:
+        print("❌ WEBHOOK_URL is required in webhook mode.")
+        return
+    
+    # Create application - updates are handled concurrently so a running
+    # job never delays button presses from other users
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(api_scheduler)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if LOCAL_MODE:
+        # getFile returns local paths and uploads go by file:// path
+        builder = (
+            builder
+            .base_url(LOCAL_BOT_API_URL)
+            .base_file_url(LOCAL_BOT_API_FILE_URL)
+            .local_mode(True)
+        )
+    if DELIVERY_MODE == "webhook":
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1041,6 +4505,7 @@ def main():
     application.add_handler(CommandHandler("trackkiller", track_killer))
     application.add_handler(CommandHandler("remaudio", rem_audio))
     application.add_handler(CommandHandler("remsubtitles", rem_subtitles))
+    application.add_handler(CommandHandler("extract", extract_tracks))
     application.add_handler(CommandHandler("remallaudio", rem_all_audio))
     application.add_handler(CommandHandler("remallsubtitles", rem_all_subtitles))
     application.add_handler(CommandHandler("remall", rem_all))
@@ -1048,6 +4513,8 @@ def main():
     application.add_handler(CommandHandler("addadmin", add_admin))
     application.add_handler(CommandHandler("removeadmin", remove_admin))
     application.add_handler(CommandHandler("listadmins", list_admins))
+    application.add_handler(CommandHandler("trace", trace_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     
     # Message handlers
     application.add_handler(MessageHandler(filters.VIDEO, handle_video))
@@ -1063,8 +4530,18 @@ def main():
     print("🤖 Track Killer Bot is running...")
     print(f"📊 Max concurrent processes: {MAX_CONCURRENT_PROCESSES}")
     print(f"💾 Max file size: {MAX_FILE_SIZE // (1024*1024)}MB")
+    if LOCAL_MODE:
+        print(f"🏠 Local Bot API server: {LOCAL_BOT_API_URL}")
+    if shared_queue is not None:
+        print(f"📥 Jobs are handed to workers via the {JOB_QUEUE_BACKEND} queue")
     print(f"🔒 Private mode: Only {len(admins)} authorized users")
-    application.run_polling()
+    
+    if DELIVERY_MODE == "webhook":
+        print(f"🌐 Webhook mode: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        asyncio.run(run_webhook(application))
+    else:
+        # Polling deletes any previously registered webhook on start
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()